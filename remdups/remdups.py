@@ -23,12 +23,16 @@ Usage:
       cat > .remdups_c.sha512
       cat > .remdups_e.md5
 
-   All of .remdups_{c,b,d,e,n}.{sha512, sha384, sha256, sha224, sha1, md5} 
+   All of .remdups_{c,b,d,e,n,s}.{sha512, sha384, sha256, sha224, sha1, md5} 
    contribute to the final hash. If you don't make such a file, the default is::
 
      .remdups_c.sha256
 
-   {'c': 'content', 'b': 'block', 'd': 'date', 'e': 'exif', 'n': 'name'}
+   {'c': 'content', 'b': 'block', 'd': 'date', 'e': 'exif', 'n': 'name', 's': 'sampled'}
+
+   's' hashes the size and 8 chunks of 64KiB at fixed offsets, i.e. the same work for any file size.
+   Files of different size never have the same 's' hash, files up to 512KiB are hashed completely,
+   but larger ones differing only outside the chunks do. Use --safe to compare such files.
 
 1. Create the hash file by either of::
 
@@ -70,6 +74,16 @@ import os.path
 import argparse
 import time
 import shutil
+import stat
+import tempfile
+import json
+import mmap
+import socket
+import socketserver
+import threading
+import queue
+import zipfile
+import tarfile
 from glob import glob
 try:
    from itertools import zip_longest  # pragma: no cover
@@ -77,8 +91,11 @@ except ImportError:  # pragma: no cover
    from itertools import izip_longest as zip_longest  # pragma: no cover
 import filecmp
 import hashlib
-from itertools import product
-from collections import defaultdict
+from itertools import product, groupby
+import heapq
+import bisect
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import re
 from fnmatch import fnmatch
 normp = os.path.normpath
@@ -117,29 +134,601 @@ def remove_empty_dirs(path):          #pragma: no cover
          os.rmdir(path)               #pragma: no cover
       except: pass                    #pragma: no cover
 
+FICLONE = 0x40049409 #linux ioctl to share the extents of a file on btrfs, xfs,...
+
+def _reflink(src,dst):
+   "clones src to dst, which must not exist yet. dst is removed again, if this fails"
+   import fcntl
+   with open(src,'rb') as s, open(dst,'xb') as d:
+      try:
+         fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+         shutil.copystat(src,dst)
+      except:
+         os.remove(dst)
+         raise
+
+def relink(keep,pth,reflink=False):
+   "replace pth by a hardlink (or reflink) to keep, atomically via a temporary name"
+   if os.path.samefile(keep,pth):
+      return
+   d,n = os.path.split(pth)
+   while True:
+      #a new name, not to touch an existing file
+      tmp = joinp(d,'.{}.{}.remdups~'.format(n,os.urandom(4).hex()))
+      try:
+         if reflink:
+            _reflink(keep,tmp)
+         else:
+            os.link(keep,tmp)
+         break
+      except FileExistsError:
+         continue
+   try:
+      os.replace(tmp,pth)
+   except:
+      os.remove(tmp)
+      raise
+
 remdupsfile = lambda a,h: '.remdups_'+a+'.'+h
 
+def _fixfromdir(nfromdir):
+   "returns function to mark the start of the relative path after fromdir"
+   #// or \\ to know how to construct tree here for cp and mv
+   if nfromdir == '.':
+      #nfromdir='.'
+      return lambda p: p
+   #nfromdir=joinp(*"../../../x/y".split('/'))
+   #p=joinp(*"../../../x/y/z/n".split('/'))
+   #_fixfromdir(nfromdir)(p)
+   return lambda p: p.startswith(nfromdir) and nfromdir+os.sep*2+p[len(nfromdir):].strip(os.sep) or p
+
+def _indexlines(fn,lines=None,valid=None):
+   """yields (value,path) of the 'value path' lines of a .remdups_ file.
+   The number of lines is counted in lines[fn], if lines is given.
+   A line without newline at the end (torn by a crash) or with a value not matching valid is skipped.
+   """
+   with open(fn,'r',encoding='utf-8') as index:
+      for e in index:
+         if not e.strip():
+            continue
+         if lines is not None:
+            lines[fn] += 1
+         if not e.endswith('\n'):
+            continue
+         v,p = (re.split(r'\s+', e.strip(), maxsplit=1)+[''])[:2]
+         if not p or valid and v != '-' and not valid.match(v):
+            continue
+         yield v,p
+
+def _readindex(fn,lines=None,valid=None):
+   """returns {path: value} of _indexlines().
+   The last line of a path counts. A - as value removes the path.
+   """
+   res = {}
+   for v,p in _indexlines(fn,lines,valid):
+      if v == '-':
+         res.pop(p,None)
+      else:
+         res[p] = v
+   return res
+
+_units = {'':1,'k':1<<10,'m':1<<20,'g':1<<30,'t':1<<40}
+def parse_size(size):
+   """
+   >>> parse_size('512M') == 512*1024*1024 and parse_size('100') == 100
+   True
+   """
+   m = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)i?b?\s*$',str(size).lower())
+   if not m:
+      raise ValueError('Not a size: '+str(size))
+   return int(float(m.group(1))*_units[m.group(2)])
+
+def _external_sort(lines,mem_limit):
+   "yields the sorted lines, sorting runs of about mem_limit bytes in memory and merging them from temporary files"
+   runs, run, size = [], [], 0
+   def spill():
+      f = tempfile.TemporaryFile('w+',encoding='utf-8')
+      f.writelines(sorted(run))
+      f.seek(0)
+      runs.append(f)
+   for line in lines:
+      run.append(line)
+      size += sys.getsizeof(line)+8
+      if size >= mem_limit:
+         spill()
+         run, size = [], 0
+   if not runs:
+      for line in sorted(run):
+         yield line
+      return
+   if run:
+      spill()
+   run = None
+   try:
+      for line in heapq.merge(*runs):
+         yield line
+   finally:
+      for f in runs:
+         f.close()
+
+def _sortedindex(fn,mem_limit,topath=None):
+   """yields the 'hash\0path' lines of the .remdups_x.y file fn, sorted on disk, using about mem_limit bytes.
+   The last line of a path counts. topath maps the paths of fn.
+   """
+   def bypath():
+      for seq,(h,p) in enumerate(_indexlines(fn,valid=_hexdigest_re(fn))):
+         yield '{}\0{:012d}\0{}\n'.format(topath and topath(p) or p,seq,h)
+   def current():
+      for p, lines in groupby(_external_sort(bypath(),mem_limit),key=lambda l: l.split('\0',1)[0]):
+         for line in lines:
+            h = line.rstrip('\n').rsplit('\0',1)[1]
+         if h != '-':
+            yield '{}\0{}\n'.format(h,p)
+   return _external_sort(current(),mem_limit)
+
+def _mergejoin(here,there):
+   """yields (hash,present,paths) for the hashes of there, with paths of there and present of here.
+   here and there are 'hash\0path' lines sorted by hash, as from _sortedindex(). Both are read once.
+   """
+   key = lambda l: l.split('\0',1)[0]
+   paths = lambda lines: [l.rstrip('\n').split('\0',1)[1] for l in lines]
+   here = groupby(here,key)
+   h, hlines = next(here,(None,None))
+   for t, tlines in groupby(there,key):
+      while h is not None and h < t:
+         h, hlines = next(here,(None,None))
+      yield t, h == t and paths(hlines) or [], paths(tlines)
+
+class _Spill:
+   "a list of (tail,paths) kept in a temporary file, to iterate over"
+   def __init__(self,items=()):
+      self.file = tempfile.TemporaryFile('w+',encoding='utf-8')
+      self.n = 0
+      for item in items:
+         self.append(item)
+   def append(self,item):
+      self.file.write(json.dumps(item)+'\n')
+      self.n += 1
+   def __len__(self):
+      return self.n
+   def __iter__(self):
+      self.file.seek(0)
+      for line in self.file:
+         yield tuple(json.loads(line))
+      self.file.seek(0,os.SEEK_END)
+
+FS_IOC_FIEMAP = 0xC020660B
+def _physical(path):
+   "(0,physical offset of the first extent) by FIEMAP, if available, else (1,0)"
+   try:
+      import fcntl
+      import struct
+      #struct fiemap with room for one struct fiemap_extent
+      buf = bytearray(struct.pack('=QQLLLL',0,0xFFFFFFFFFFFFFFFF,0,0,1,0)+bytes(56))
+      fd = os.open(path,os.O_RDONLY)
+      try:
+         fcntl.ioctl(fd,FS_IOC_FIEMAP,buf,True)
+      finally:
+         os.close(fd)
+      mapped = struct.unpack_from('=L',buf,20)[0]
+      if mapped:
+         return (0,struct.unpack_from('=Q',buf,40)[0])
+   except Exception:
+      pass
+   return (1,0)
+
+def _listed(f):
+   "yields the paths in file f, separated by NUL if there is one in the first 64KiB, else by newlines"
+   chunk = f.read(1<<16)
+   sep = '\0' in chunk and '\0' or '\n'
+   rest = ''
+   while chunk:
+      paths = (rest+chunk).split(sep)
+      rest = paths.pop()
+      for p in paths:
+         p = sep == '\n' and p.rstrip('\r') or p
+         if p:
+            yield p
+      chunk = f.read(1<<16)
+   if rest:
+      yield rest
+
+def _hexdigest_re(hashfile):
+   "regex to validate the hashes in .remdups_x.y"
+   n = getattr(hashlib,hashfile.split('.')[-1])().digest_size*2
+   return re.compile('^[0-9a-f]{%d}$'%n)
+
+def _repair_tail(fn):
+   "truncate a line torn by a crash at the end of fn, before appending to it"
+   try:
+      with open(fn,'rb+') as f:
+         size = f.seek(0,os.SEEK_END)
+         if size == 0:
+            return
+         f.seek(size-1)
+         if f.read(1) == b'\n':
+            return
+         pos = size
+         while pos > 0:
+            n = min(pos,1<<16)
+            f.seek(pos-n)
+            buf = f.read(n)
+            i = buf.rfind(b'\n')
+            if i >= 0:
+               pos = pos-n+i+1
+               break
+            pos -= n
+         f.truncate(pos)
+   except FileNotFoundError:
+      pass
+
+def _atomic_write(fn,lines):
+   """write lines to fn via a temporary file, fsync and rename, such that fn is either old or new.
+   lines can be a generator. Returns the number of lines written."""
+   d = os.path.dirname(fn) or '.'
+   fd,tmp = tempfile.mkstemp(dir=d,prefix=os.path.basename(fn)+'.')
+   n = 0
+   try:
+      with open(fd,'w',encoding='utf-8') as f:
+         for line in lines:
+            f.write(line)
+            n += 1
+         f.flush()
+         os.fsync(f.fileno())
+      if os.path.exists(fn):
+         shutil.copymode(fn,tmp)
+      os.replace(tmp,fn)
+   except:
+      os.remove(tmp)
+      raise
+   if hasattr(os,'O_DIRECTORY'):
+      dfd = os.open(d,os.O_RDONLY|os.O_DIRECTORY)
+      try:
+         os.fsync(dfd)
+      finally:
+         os.close(dfd)
+   return n
+
+#sha256sum/md5sum (GNU) and BSD (tag) format of checksum manifests
+_gnusum = re.compile(r'^(\\?)([0-9a-fA-F]+) [ *](.*)$')
+_bsdsum = re.compile(r'^([A-Z]+[0-9]*) ?\((.*)\) ?= ([0-9a-fA-F]+)$')
+_sumlen = {32:'md5',40:'sha1',56:'sha224',64:'sha256',96:'sha384',128:'sha512'}
+
+def _parse_sums(manifest):
+   "yields (algo,hash,path) from a sha256sum, md5sum,... or BSD style manifest"
+   with open(manifest,'r',encoding='utf-8') as sums:
+      for line in sums:
+         line = line.rstrip('\r\n')
+         gnu = _gnusum.match(line)
+         if gnu:
+            esc,h,p = gnu.groups()
+            if esc:
+               p = p.replace('\\\\','\0').replace('\\n','\n').replace('\0','\\')
+            algo = _sumlen.get(len(h))
+         else:
+            bsd = _bsdsum.match(line)
+            if not bsd:
+               continue
+            algo,p,h = bsd.groups()
+            algo = algo.lower().replace('-','')
+         if algo not in Hasher.hashes:
+            continue
+         yield algo,h.lower(),p
+
+def sums_hashfile(manifest,source='c'):
+   "the .remdups_x.y file that a manifest is imported into"
+   for algo,h,p in _parse_sums(manifest):
+      return remdupsfile(source,algo)
+   raise ValueError('No checksums found in '+manifest)
+
+def _dhash(path,size=8):
+   "difference hash of an image, as size*size bits in hex digits, or None if not an image (needs PIL)"
+   try:
+      from PIL import Image
+      with Image.open(path) as img:
+         px = img.convert('L').resize((size+1,size),Image.LANCZOS).tobytes()
+   except Exception:
+      return None
+   bits = 0
+   for r in range(size):
+      for c in range(size):
+         i = r*(size+1)+c
+         bits = bits<<1 | (px[i] > px[i+1])
+   return '{:0{}x}'.format(bits,size*size//4)
+
+def hamming(a,b):
+   "number of different bits of the integers a and b"
+   return bin(a^b).count('1')
+
+class BKTree:
+   """Burkhard-Keller tree of integers with the hamming distance.
+   query() only visits the subtrees that can contain values within the distance.
+   """
+   def __init__(self,values=()):
+      self.root = None
+      for v in values:
+         self.add(v)
+   def add(self,value):
+      if self.root is None:
+         self.root = (value,{})
+         return
+      node = self.root
+      while True:
+         d = hamming(value,node[0])
+         if d == 0:
+            return
+         if d not in node[1]:
+            node[1][d] = (value,{})
+            return
+         node = node[1][d]
+   def query(self,value,k):
+      "yields (distance,v) for all v within distance k of value"
+      nodes = self.root and [self.root] or []
+      while nodes:
+         v, children = nodes.pop()
+         d = hamming(value,v)
+         if d <= k:
+            yield d, v
+         nodes.extend([c for e,c in children.items() if d-k <= e <= d+k])
+
+class _Throttle:
+   """Token buckets for bytes and files per second, shared by all threads.
+   A take() beyond the rate sleeps until its tokens are due.
+   If adaptive, the rates are halved while the read latency is more than twice the lowest seen,
+   and slowly raised again otherwise.
+   """
+   def __init__(self,bytes_per_sec=None,files_per_sec=None,adaptive=False):
+      self.rates = {'bytes':bytes_per_sec,'files':files_per_sec}
+      self.tokens = {k:r or 0 for k,r in self.rates.items()}
+      self.adaptive = adaptive
+      self.factor = 1.0
+      self.latency = self.lowest = None
+      self.adapted = self.last = time.monotonic()
+      self.lock = threading.Lock()
+   def take(self,kind,n=1):
+      rate = self.rates[kind]
+      if not rate:
+         return
+      with self.lock:
+         now = time.monotonic()
+         for k,r in self.rates.items():
+            if r:#a burst of up to one second
+               self.tokens[k] = min(r,self.tokens[k]+(now-self.last)*r*self.factor)
+         self.last = now
+         self.tokens[kind] -= n
+         wait = -self.tokens[kind]/(rate*self.factor)
+      if wait > 0:
+         time.sleep(wait)
+   def observe(self,seconds):
+      "adapts to the latency of a read"
+      if not self.adaptive:
+         return
+      with self.lock:
+         self.latency = seconds if self.latency is None else 0.8*self.latency+0.2*seconds
+         self.lowest = min(self.lowest or self.latency,self.latency)
+         now = time.monotonic()
+         if now-self.adapted >= 0.5:
+            self.adapted = now
+            if self.latency > 2*self.lowest:
+               self.factor = max(self.factor/2,1/64)
+            else:
+               self.factor = min(self.factor*1.25,1.0)
+
+def _throttle(args):
+   "a _Throttle according to the max_bytes_per_sec, max_files_per_sec and adaptive args, or None"
+   bps, fps = args.get('max_bytes_per_sec'), args.get('max_files_per_sec')
+   if bps or fps:
+      return _Throttle(bps and parse_size(bps),fps,args.get('adaptive',False))
+
+def _timed(throttle,read,*args):
+   "read(*args), telling throttle the bytes and the latency"
+   if throttle is None:
+      return read(*args)
+   start = time.monotonic()
+   data = read(*args)
+   throttle.observe(time.monotonic()-start)
+   throttle.take('bytes',len(data))
+   return data
+
+def _samples(path,k,size,throttle=None):
+   "yields the file size and k chunks of size bytes at evenly spaced offsets, or the whole content if not larger"
+   n = os.path.getsize(path)
+   yield _encode(str(n)+'\0')
+   with open(path,'rb') as f:
+      try:
+         if n <= k*size:
+            yield _timed(throttle,f.read)
+            return
+         for i in range(k):
+            offset = i*(n-size)//(k-1)
+            if hasattr(os,'pread'):
+               yield _timed(throttle,os.pread,f.fileno(),size,offset)
+            else: # pragma: no cover
+               f.seek(offset)
+               yield _timed(throttle,f.read,size)
+      finally:
+         _fadvise(f.fileno(),'DONTNEED')
+
+def _fadvise(fd,advice):
+   "posix_fadvise(fd,0,0,POSIX_FADV_<advice>), where available"
+   if hasattr(os,'posix_fadvise'):
+      try:
+         os.posix_fadvise(fd,0,0,getattr(os,'POSIX_FADV_'+advice))
+      except OSError: # pragma: no cover
+         pass
+
+def _blocks(path,blocksize,direct=False,throttle=None):
+   """Yields the content of path in blocks of blocksize, read sequentially and dropped from the page cache afterwards.
+   With direct, O_DIRECT is used, if the file system allows it. blocksize must then be a multiple of the page size.
+   The reads are limited by throttle, a _Throttle.
+   """
+   if throttle is not None:
+      throttle.take('files')
+   fd, buf = None, None
+   if direct and hasattr(os,'O_DIRECT'):
+      try:
+         fd = os.open(path,os.O_RDONLY|os.O_DIRECT)
+         buf = mmap.mmap(-1,blocksize)#page aligned
+      except OSError:
+         fd = None
+   if fd is None:
+      fd = os.open(path,os.O_RDONLY|getattr(os,'O_BINARY',0))
+   pos = 0
+   try:
+      _fadvise(fd,'SEQUENTIAL')
+      while True:
+         if buf is not None:
+            try:
+               data = _timed(throttle,lambda: buf[:os.readv(fd,[buf])])
+            except OSError:#O_DIRECT not supported after all
+               os.close(fd)
+               buf.close()
+               fd, buf = os.open(path,os.O_RDONLY), None
+               os.lseek(fd,pos,os.SEEK_SET)
+               continue
+         else:
+            data = _timed(throttle,os.read,fd,blocksize)
+         if not data:
+            break
+         pos += len(data)
+         yield data
+   finally:
+      _fadvise(fd,'DONTNEED')
+      os.close(fd)
+      if buf is not None:
+         buf.close()
+
+def samecontent(f1,f2,direct=False,throttle=None):
+   "bytewise comparison of the files f1 and f2, via _blocks()"
+   if os.path.getsize(f1) != os.path.getsize(f2):
+      return False
+   blocksize = 16*filecmp.BUFSIZE
+   r1, r2 = _blocks(f1,blocksize,direct,throttle), _blocks(f2,blocksize,direct,throttle)
+   try:
+      for b1, b2 in zip_longest(r1,r2,fillvalue=b''):
+         if b1 != b2:
+            return False
+      return True
+   finally:
+      r1.close()
+      r2.close()
+
+_archive_re = r'\.(?:zip|tar|tgz|tbz2?|txz|tar\.(?:gz|bz2|xz))'
+_member_re = re.compile('(.*?'+_archive_re+')::',re.I)
+def _memberof(path):
+   "the archive of a virtual path archive::member, else None"
+   m = _member_re.match(path)
+   return m and m.group(1)
+
+def _members(path):
+   """yields (name,open,size,mtime) of the files in the zip or tar archive path.
+   open() returns a file object to read the member from the archive, without extracting it.
+   """
+   if zipfile.is_zipfile(path):
+      with zipfile.ZipFile(path) as z:
+         for info in z.infolist():
+            if not info.is_dir():
+               yield (info.filename,lambda info=info: z.open(info),info.file_size,
+                     time.mktime(info.date_time+(0,0,-1)))
+   else:
+      with tarfile.open(path,'r:*') as t:
+         for info in t:
+            if info.isfile():
+               yield info.name,lambda info=info: t.extractfile(info),info.size,info.mtime
+
+def _readall(f,blocksize,throttle=None):
+   "yields the content of the file object f in blocks of blocksize and closes it"
+   with f:
+      if throttle is not None:
+         throttle.take('files')
+      while True:
+         data = _timed(throttle,f.read,blocksize)
+         if not data:
+            break
+         yield data
+
+def _stream_samples(blocks,n,k,size):
+   "like _samples(), but from the blocks of a stream of n bytes"
+   yield _encode(str(n)+'\0')
+   if n <= k*size:
+      yield b''.join(blocks)
+      return
+   offsets = [i*(n-size)//(k-1) for i in range(k)]
+   pos, chunk, i = 0, b'', 0
+   for block in blocks:
+      end = pos+len(block)
+      while i < k and offsets[i] < end:
+         chunk += block[max(offsets[i],pos)-pos:min(offsets[i]+size,end)-pos]
+         if offsets[i]+size > end:
+            break
+         yield chunk
+         chunk, i = b'', i+1
+      pos = end
+
+def _signature(path):
+   "(path,size,mtime_ns,inode) of path: if one of them changes, an earlier comparison does not hold any more"
+   st = os.stat(path)
+   return (path,st.st_size,st.st_mtime_ns,st.st_ino)
+
+def _readverified(fn):
+   "{(signature,signature): same} from the JSON lines of fn, skipping invalid (e.g. torn) lines"
+   verified = {}
+   if os.path.exists(fn):
+      with open(fn,'r',encoding='utf-8') as f:
+         for line in f:
+            try:
+               same, sig1, sig2 = json.loads(line)
+               verified[(tuple(sig1),tuple(sig2))] = same
+            except ValueError:
+               pass
+   return verified
+
 class Hasher:
-   sources = 'c b d e n'.split()
+   sources = 'c b d e n s'.split()
    hashes = 'sha512 sha384 sha256 sha224 sha1 md5'.split()
    hashfilenames = [remdupsfile(a,h) for a,h in product(sources,hashes)]
-   def __init__(self):
+   dirsfile = '.remdups_dirs'
+   resumefile = '.remdups_resume'
+   phashfile = '.remdups_p.dhash'
+   verifiedfile = '.remdups_verified'
+   membersep = '::'
+   verifyfile = '.remdups_verify'
+   sizefile = '.remdups_size'
+   samples, samplesize = 8, 64*1024
+   batchsize = 1000
+   #large and page aligned: with O_DIRECT there is no readahead
+   readsize = 1<<20
+   def __init__(self,defaulthashfile='.remdups_c.sha256'):
       self.hashfiles = []
       for h in Hasher.hashfilenames:
          if os.path.exists(h):
             self.hashfiles.append(h)
       if not self.hashfiles:
-         defaulthashfile = '.remdups_c.sha256'
          with open(defaulthashfile,'w'): pass
          self.hashfiles.append(defaulthashfile)
+      #perceptual hashes of images are made, if this file exists
+      self.phash = os.path.exists(Hasher.phashfile)
+      #read with O_DIRECT
+      self.direct = False
+      #a _Throttle for all reads
+      self.throttle = None
+      self.repaired = set()
       self.clear()
    def load_hashes(self):
+      lines = defaultdict(int)
       for hfn in self.hashfiles:
-         with open(hfn,'r',encoding='utf-8') as hashfile:
-            for e in hashfile.readlines():
-               h,p = re.split(r'\s+', e.strip(), maxsplit=1)
-               self.path_hash[p]+=h #combine hashes from different .remdups_x.y
+         index = _readindex(hfn,lines,_hexdigest_re(hfn))
+         for p,h in index.items():
+            self.path_hash[p]+=h #combine hashes from different .remdups_x.y
+         self.stale += lines[hfn]-len(index) #lines replaced by later ones or removed
+         self.lines += lines[hfn]
       self._make_hash_paths()
+      if self.phash:
+         self.path_phash = _readindex(Hasher.phashfile,valid=re.compile('^[0-9a-f]{16}$'))
+      if os.path.exists(Hasher.sizefile):
+         self.path_size = {p:int(z) for p,z in _readindex(Hasher.sizefile,valid=re.compile('^[0-9]+$')).items()}
+      if os.path.exists(Hasher.dirsfile):
+         self.dir_stamp = _readindex(Hasher.dirsfile)
    @staticmethod
    def relpath(path):
       return normp(os.path.relpath(path))
@@ -153,6 +742,10 @@ class Hasher:
             self.clear(f)
          else:
             self.update_hashfiles()
+   def iter_hashed(self,*k,**kw):
+      "Like hashall(), but yields (path,hash) of each newly hashed file"
+      for path in self.scandir(*k,**kw):
+         yield path, self.path_hash[path]
    def hashall(self,*k,**kw):
       "Finds files not yet hashed and adds their hashes to the .remdups_* files"
       for x in self.scandir(*k,**kw): pass
@@ -161,48 +754,590 @@ class Hasher:
          ,filter=[]
          ,exclude=[]
          ,content=None
+         ,full=False
+         ,checkpoint_files=None
+         ,checkpoint_seconds=None
+         ,resume_at=None
+         ,files_from=None
+         ,device_jobs=None
+         ,archives=False
+         ,walk_jobs=None
          ,**other
          ):
-      fok = [normp(f) for f in filter]
-      no = [normp(f) for f in exclude if not f.startswith('!')]+[r".remdups_*"]
-      yes = [normp(f[1:]) for f in exclude if f.startswith('!')]
+      """Hashes the files not yet hashed and yields their paths.
+      Without filter and exclude the folders are recorded in .remdups_dirs.
+      Unless full, folders that did not change since, are not listed again.
+      The new hashes are appended per folder, or, with checkpoint_files or checkpoint_seconds,
+      every so many files or seconds with fsync, recording the position in .remdups_resume.
+      resume_at is such a recorded position: the walk continues after it.
+      With files_from (a file or list of paths), only those are hashed, see scanlisted().
+      With device_jobs, the files are hashed in batches by hashmany().
+      With archives, also the files in zip and tar archives are hashed, see hashmembers().
+      With walk_jobs, folders are listed ahead by so many threads, see walk().
+      """
+      if files_from is not None:
+         if hasattr(files_from,'read'):
+            files_from = _listed(files_from)
+         for path in self.scanlisted(files_from,fromdir,filter,exclude,content):
+            yield path
+         return
+      skip = self._selector(filter,exclude)
       nfromdir = self.relpath(fromdir)
-      for root, dirs, files in os.walk(nfromdir):
-         drfl = [(0,x) for x in sorted(files)]+[(1,y) for y in sorted(dirs)]
-         newdirs=[]
-         for dir,name in drfl:
-            path = joinp(root, name)
-            repth = self.relpath(path)
-            if any([fnmatch(repth,f) for f in no]) and not any([fnmatch(path,f) for f in yes]):
-               continue
-            if not dir:
-               if not (any([fnmatch(repth,f) for f in fok]) or not fok):
+      fixfromdir = _fixfromdir(nfromdir)
+      #with content, duplicates are not added (foreachcontent)
+      recorddirs = not filter and not exclude and content is None
+      checkpointing = checkpoint_files or checkpoint_seconds
+      state = dict(fromdir=fromdir,filter=filter,exclude=exclude,last=resume_at)
+      last, nhashed, lastcheckpoint = None, 0, time.time()
+      device_jobs = content is None and device_jobs
+      archives = content is None and archives
+      batch, stamps = [], []
+      def checkpoint():
+         self.update_hashfiles(fromdir,fsync=True)
+         if last:
+            state['last'] = os.path.relpath(last,nfromdir).split(os.sep)
+         _atomic_write(Hasher.resumefile,[json.dumps(state)])
+      def flush():
+         #folders are recorded only after their files are hashed
+         nonlocal last, nhashed, lastcheckpoint
+         if device_jobs:
+            done = self.hashmany(batch,device_jobs)
+         else:
+            done = (self.hash(path,content) or path for path in batch)
+         for i,path in enumerate(done):
+            nhashed += 1
+            if archives and _memberof(path+Hasher.membersep):
+               for member in self.hashmembers(path):
+                  yield member
+            if i == len(batch)-1:#all done, also when the consumer stops after this
+               last = batch[-1]
+            yield path
+            if content!=None:
+               content.clear()
+         del batch[:]
+         for stamp,root in stamps:
+            self.dir_stamp[root] = stamp
+            self.dirs2write.append((stamp,root))
+         del stamps[:]
+         if checkpointing and (checkpoint_files and nhashed >= checkpoint_files
+               or checkpoint_seconds and time.time()-lastcheckpoint >= checkpoint_seconds):
+            checkpoint()
+            nhashed, lastcheckpoint = 0, time.time()
+      try:
+         for root, dirs, files, stamp in self.walk(nfromdir,recorddirs and not full,walk_jobs):
+            if resume_at:
+               #skip what was before resume_at in the sorted walk
+               rel = [x for x in os.path.relpath(root,nfromdir).split(os.sep) if x != '.']
+               if rel == resume_at[:len(rel)]:
+                  if len(rel) == len(resume_at)-1:
+                     files = [f for f in files if f > resume_at[-1]]
+                  else:
+                     files = []
+                     dirs[:] = [d for d in dirs if d >= resume_at[len(rel)]]
+            drfl = [(0,x) for x in files]+[(1,y) for y in dirs]
+            newdirs=[]
+            for dir,name in drfl:
+               path = joinp(root, name)
+               if skip(path,dir):
                   continue
-               if path not in self.path_hash:
-                  self.hash(path,content)
+               if not dir:
+                  if self._key(path,fixfromdir) is None:
+                     batch.append(path)
+                     if not device_jobs:
+                        for path in flush():
+                           yield path
+               else:
+                  newdirs.append(name)
+            dirs[:]=newdirs
+            if recorddirs and stamp:
+               stamps.append((stamp+':'+str(len(newdirs))+':'+self.hashfiles_tag(),root))
+            if not device_jobs or len(batch) >= Hasher.batchsize:
+               for path in flush():
                   yield path
-                  if content!=None:
-                     content.clear()
+            if not checkpointing:
+               self.update_hashfiles(fromdir)
+         for path in flush():
+            yield path
+      except BaseException:
+         if checkpointing:
+            checkpoint()
+         raise
+      self.update_hashfiles(fromdir,fsync=bool(checkpointing))
+      if checkpointing and os.path.exists(Hasher.resumefile):
+         os.remove(Hasher.resumefile)
+   def scanlisted(self,paths,fromdir='.',filter=[],exclude=[],content=None):
+      """Hashes the listed files below fromdir, also if hashed already, and yields them.
+      Listed paths that do not exist any more are removed from the hashes.
+      """
+      skip = self._selector(filter,exclude)
+      nfromdir = self.relpath(fromdir)
+      fixfromdir = _fixfromdir(nfromdir)
+      for n,listed in enumerate(paths):
+         rel = os.path.relpath(listed,nfromdir)
+         parts = rel.split(os.sep)
+         if parts[0] in [os.curdir,os.pardir]:
+            continue
+         if any([skip(joinp(nfromdir,*parts[:i]),1) for i in range(1,len(parts))]):
+            continue
+         path = joinp(nfromdir,rel)
+         key = self._key(path,fixfromdir)
+         if os.path.isfile(path):
+            if skip(path,0):
+               continue
+            if key is not None:
+               self.clear(key)
+            self.hash(path,content)
+            yield path
+            if content!=None:
+               content.clear()
+         elif key is not None and not os.path.exists(path):
+            self.forget(path,fromdir)
+         if n % 1000 == 999:
+            self.update_hashfiles(fromdir)
+      self.update_hashfiles(fromdir)
+   def hashmany(self,paths,jobs=1):
+      """Hashes paths with jobs threads per device (st_dev) and yields them when done.
+      The files of a device are read in the order of their physical offset (FIEMAP), else of their inode,
+      to avoid seeks on rotating disks.
+      """
+      bydev = defaultdict(list)
+      for path in paths:
+         try:
+            st = os.stat(path)
+            bydev[st.st_dev].append((_physical(path),st.st_ino,path))
+         except OSError:
+            bydev[None].append(((1,0),0,path))
+      results = queue.Queue()
+      def run(todo,lock):
+         while True:
+            with lock:
+               item = next(todo,None)
+            if item is None:
+               break
+            path = item[-1]
+            try:
+               results.put((path,self._digests(path),None))
+            except Exception as e:
+               results.put((path,None,e))
+      with ThreadPoolExecutor(max(1,jobs*len(bydev))) as pool:
+         for items in bydev.values():
+            todo, lock = iter(sorted(items)), threading.Lock()
+            for i in range(jobs):
+               pool.submit(run,todo,lock)
+         for i in range(sum([len(items) for items in bydev.values()])):
+            path, digests, e = results.get()
+            if e:
+               raise e
+            self._record(path,*digests)
+            yield path
+   def verify(self,part=None,jobs=4):
+      """Rehashes the files in the index with jobs threads and yields (status,path),
+      status being 'ok', 'changed' (other hash than in the index) or 'missing'.
+      Each .remdups_x.y file is compared on its own, if it has the path.
+      With part N, only the next 1/N of the (sorted) paths are done,
+      continuing after the position recorded in .remdups_verify, which is updated on the way.
+      """
+      paths = sorted([p for p in self.path_hash if not _memberof(p)])
+      if part and paths:
+         last = None
+         if os.path.exists(Hasher.verifyfile):
+            with open(Hasher.verifyfile,'r',encoding='utf-8') as f:
+               last = json.load(f).get('last')
+         start = last and bisect.bisect_right(paths,last) or 0
+         count = -(-len(paths)//part)
+         paths = (paths[start:]+paths[:start])[:count]
+      #the hashes per .remdups_x.y, of the paths to check
+      wanted = set(paths)
+      stored = [{} for hfn in self.hashfiles]
+      for i,hfn in enumerate(self.hashfiles):
+         for h,p in _indexlines(hfn,valid=_hexdigest_re(hfn)):
+            if p not in wanted:
+               continue
+            if h == '-':
+               stored[i].pop(p,None)
             else:
-               newdirs.append(name)
-         dirs[:]=newdirs
-         self.update_hashfiles(fromdir)
-   def update_hashfiles(self,fromdir='.'):
+               stored[i][p] = h
+      def check(path):
+         try:
+            hshs, phsh, size = self._digests(normp(path),phash=False)
+         except OSError:
+            return 'missing', path
+         same = all([hshs[i] == stored[i][path] for i in range(len(hshs)) if path in stored[i]])
+         return same and 'ok' or 'changed', path
+      def record(path):
+         _atomic_write(Hasher.verifyfile,[json.dumps(dict(last=path))])
+      done = None
+      try:
+         for n,(status,path) in enumerate(_pooled(check,paths,jobs)):
+            done = path
+            yield status, path
+            if part and n % 1000 == 999:
+               record(done)
+      finally:
+         if part and done:
+            record(done)
+   def hashmembers(self,archive):
+      """Hashes the files in the zip or tar archive, reading them from it without extracting,
+      and yields their virtual paths archive::member.
+      A member that cannot be read (encrypted, unsupported compression, corrupt) is skipped.
+      """
+      try:
+         for name,open_,size,mtime in _members(archive):
+            path = archive+Hasher.membersep+name
+            try:
+               digests = self._digests(path,member=(open_,size,mtime))
+            except Exception:#RuntimeError, NotImplementedError, zlib.error, lzma.LZMAError,...
+               continue
+            self._record(path,*digests)
+            yield path
+      except (OSError,EOFError,zipfile.BadZipFile,tarfile.TarError):
+         pass #not a valid archive: only the file itself is hashed
+   def hashfiles_tag(self):
+      "the .remdups_x.y files, as recorded with the folders in .remdups_dirs, e.g. 'b.sha256,c.sha256'"
+      return ','.join(sorted([os.path.basename(h)[len('.remdups_'):] for h in self.hashfiles]))
+   def walk(self,top,usestamps=True,jobs=None):
+      """Like os.walk(top), but yields (root,dirs,files,stamp), sorted.
+      stamp is 'mtime_ns:number of entries' of root, if it can be recorded.
+      If usestamps and root's mtime is as in self.dir_stamp ('mtime_ns:entries:dirs:hashfiles'),
+      root is not listed: files are [], because they are hashed already, and dirs are as recorded.
+      A stamp recorded with other .remdups_x.y files (see hashfiles_tag()) is not trusted.
+      With jobs, the next folders of the walk are listed ahead by so many threads,
+      which hides the latency of network file systems. The order stays the same.
+      """
+      subdirs = defaultdict(list)
+      tag = self.hashfiles_tag()
+      if usestamps:
+         for d in self.dir_stamp:
+            subdirs[os.path.dirname(d)].append(os.path.basename(d))
+      def listing(root):
+         try:
+            st = os.stat(root)
+            mtime = str(st.st_mtime_ns)
+            recorded = self.dir_stamp.get(root,':::').split(':')
+            known = subdirs.get(root,[])
+            if (usestamps and recorded[0] == mtime and recorded[2] == str(len(known))
+                  and recorded[3:] == [tag]):
+               return sorted(known), [], None
+            entries = list(os.scandir(root))
+            dirs = sorted([e.name for e in entries if e.is_dir() and not e.is_symlink()])
+            files = sorted([e.name for e in entries if not e.is_dir()])
+            #no record if changes within the same mtime are still possible
+            stamp = st.st_mtime < time.time()-2 and '{}:{}'.format(mtime,len(entries)) or None
+            return dirs, files, stamp
+         except OSError:
+            return None
+      jobs = jobs and jobs > 1 and jobs or 0
+      with ThreadPoolExecutor(max(1,jobs)) as pool:
+         #[root, listing future]; the last ones are the next ones of the walk
+         tops = [[top,None]]
+         while tops:
+            if jobs:
+               for ahead in tops[-4*jobs:]:
+                  if ahead[1] is None:
+                     ahead[1] = pool.submit(listing,ahead[0])
+            root, listed = tops.pop()
+            if listed:
+               listed = listed.result()
+            else:
+               listed = listing(root)
+            if listed is None:
+               continue
+            dirs, files, stamp = listed
+            yield root, dirs, files, stamp
+            #dirs may have been pruned by the consumer
+            tops.extend([joinp(root,d),None] for d in reversed(dirs))
+   def _key(self,path,fixfromdir):
+      "the path as in self.path_hash, else None"
+      for key in [path,fixfromdir(path)]:
+         if key in self.path_hash:
+            return key
+   def forget(self,path,fromdir='.'):
+      "removes path from the hashes and marks it as removed in the .remdups_ files"
+      key = self._key(path,_fixfromdir(self.relpath(fromdir)))
+      if key is not None:
+         hadphash = key in self.path_phash
+         self.clear(key)
+         for i in range(len(self.hashfiles)):
+            self.hashes2write[i].append(('-',path))
+         if hadphash:
+            self.phash2write.append(('-',path))
+         self.size2write.append(('-',path))
+   def watch(self
+         ,fromdir='.'
+         ,filter=[]
+         ,exclude=[]
+         ,debounce=1.0
+         ,interval=2.0
+         ,poll=False
+         ,**other
+         ):
+      """Keeps the hashes of fromdir up to date, after hashing what is missing.
+      Uses inotify on linux, else polls every interval seconds.
+      Changed files are rehashed, when not changed for debounce seconds.
+      Deleted files are removed. Yields (changed,deleted) at least every interval seconds.
+      """
+      self.hashall(fromdir,filter,exclude)
+      skip = self._selector(filter,exclude)
       nfromdir = self.relpath(fromdir)
-      #// or \\ to know how to construct tree here for cp and mv
-      if nfromdir == '.':
-         #nfromdir='.'
-         fixfromdir = lambda p: p
+      fixfromdir = _fixfromdir(nfromdir)
+      def walk(top=nfromdir):
+         for root, dirs, files in os.walk(top):
+            dirs[:] = [d for d in sorted(dirs) if not skip(joinp(root,d),1)]
+            yield root, [joinp(root,f) for f in sorted(files) if not skip(joinp(root,f),0)]
+      def under(dirpath):
+         return [p for p in self.path_hash if p.startswith(dirpath+os.sep) or p.startswith(fixfromdir(dirpath)+os.sep)]
+      def snapshot():
+         snap = {}
+         for root, files in walk():
+            for f in files:
+               try:
+                  st = os.stat(f)
+                  snap[f] = (st.st_mtime_ns,st.st_size)
+               except OSError:
+                  pass
+         return snap
+      inotify = None
+      if not poll:
+         try:
+            inotify = _Inotify()
+         except OSError:
+            pass
+      if inotify:
+         for root, files in walk():
+            inotify.add(root)
       else:
-         #nfromdir=joinp(*"../../../x/y".split('/'))
-         fixfromdir=lambda p: p.startswith(nfromdir) and nfromdir+os.sep*2+p[len(nfromdir):].strip(os.sep) or p
-      #p=joinp(*"../../../x/y/z/n".split('/'))
-      #fixfromdir(p)
+         last = snapshot()
+      pending = {}
+      try:
+         while True:
+            now = time.time()
+            if inotify:
+               wait = min([interval]+[t+debounce-now for t in pending.values()])
+               for mask,path in inotify.read(max(wait,0)):
+                  if path is None:#overflow: compare with what is there
+                     for p in list(self.path_hash):
+                        pending[p] = now
+                     for root, files in walk():
+                        pending.update([(f,now) for f in files])
+                  elif mask & _Inotify.IN_ISDIR:
+                     if skip(path,1):
+                        continue
+                     pending.update([(p,now) for p in under(path)])
+                     if mask & (_Inotify.IN_CREATE|_Inotify.IN_MOVED_TO):
+                        for root, files in walk(path):
+                           inotify.add(root)
+                           pending.update([(f,now) for f in files])
+                  elif not skip(path,0):
+                     pending[path] = now
+            else:
+               time.sleep(interval)
+               snap = snapshot()
+               now = time.time()
+               pending.update([(p,now) for p in set(snap)|set(last) if snap.get(p) != last.get(p)])
+               last = snap
+            now = time.time()
+            changed, deleted = [], []
+            for path in [p for p,t in pending.items() if t+debounce <= now]:
+               del pending[path]
+               if path.startswith(nfromdir+os.sep*2):
+                  path = nfromdir+os.sep+path[len(nfromdir)+2:]
+               key = self._key(path,fixfromdir)
+               if os.path.isfile(path) and not skip(path,0):
+                  if key is not None:
+                     self.clear(key)
+                  self.hash(path)
+                  changed.append(path)
+               elif key is not None:
+                  self.forget(path,fromdir)
+                  deleted.append(path)
+            self.update_hashfiles(fromdir)
+            yield changed, deleted
+      finally:
+         if inotify:
+            inotify.close()
+   def _selector(self,filter=[],exclude=[]):
+      "returns skip(path,isdir) according to filter and exclude"
+      fok = [normp(f) for f in filter]
+      no = [normp(f) for f in exclude if not f.startswith('!')]+[r".remdups_*"]
+      yes = [normp(f[1:]) for f in exclude if f.startswith('!')]
+      def skip(path,isdir):
+         repth = self.relpath(path)
+         if any([fnmatch(repth,f) for f in no]) and not any([fnmatch(path,f) for f in yes]):
+            return True
+         return not isdir and not (any([fnmatch(repth,f) for f in fok]) or not fok)
+      return skip
+   def update_hashfiles(self,fromdir='.',fsync=False):
+      fixfromdir = _fixfromdir(self.relpath(fromdir))
+      def append(fn,lines):
+         if fn not in self.repaired:
+            _repair_tail(fn)
+            self.repaired.add(fn)
+         with open(fn,'a',encoding='utf-8') as index:
+            index.writelines(lines)
+            if fsync:
+               index.flush()
+               os.fsync(index.fileno())
       for i,hfn in enumerate(self.hashfiles):
          if len(self.hashes2write[i]) > 0:
-            with open(hfn,'a',encoding='utf-8') as hashfile:
-               hashfile.writelines(['{}\t{}\n'.format(h, fixfromdir(p)) for h,p in self.hashes2write[i]])
+            append(hfn,['{}\t{}\n'.format(h, fixfromdir(p)) for h,p in self.hashes2write[i]])
       self.hashes2write = defaultdict(list)
+      if self.dirs2write:
+         append(Hasher.dirsfile,['{}\t{}\n'.format(s, d) for s,d in self.dirs2write])
+      self.dirs2write = []
+      if self.phash2write:
+         append(Hasher.phashfile,['{}\t{}\n'.format(h, fixfromdir(p)) for h,p in self.phash2write])
+      self.phash2write = []
+      if self.size2write:
+         append(Hasher.sizefile,['{}\t{}\n'.format(z, fixfromdir(p)) for z,p in self.size2write])
+      self.size2write = []
+   def merkle(self):
+      """Returns ({folder: hash}, {folder: number of files}, {folder: [(name,subfolder or None)]}).
+      The hash of a folder is formed from the names and hashes of its files and subfolders in the index, bottom-up.
+      """
+      entries = defaultdict(list)
+      for p,h in self.path_hash.items():
+         if _memberof(p):
+            continue
+         d,n = os.path.split(p)
+         entries[d].append((n,None,'f'+h))
+      depth = lambda d: normp(d) != '.' and normp(d).count(os.sep)+1 or 0
+      linked = set()
+      for d in list(entries):
+         while d not in linked:
+            linked.add(d)
+            parent,n = os.path.split(d)
+            if not parent or not n or parent == d:
+               break
+            entries[parent].append((n,d,None))
+            d = parent
+      dir_hash, dir_files = {}, defaultdict(int)
+      for d in sorted(entries,key=depth,reverse=True):
+         m = hashlib.sha256()
+         for n,sub,h in sorted(entries[d],key=lambda e: e[0]):
+            if sub:
+               h = 'd'+dir_hash[sub]
+               dir_files[d] += dir_files[sub]
+            else:
+               dir_files[d] += 1
+            m.update(_fnencode(n+'\0'+h+'\n'))
+         dir_hash[d] = m.hexdigest()
+      return dir_hash, dir_files, {d:[(n,sub) for n,sub,h in e] for d,e in entries.items()}
+   def external_groups(self,mem_limit):
+      """Yields (hash,paths) like self.hash_paths.items(), but sorted by hash,
+      without loading the .remdups_ files, but sorting them on disk, using about mem_limit bytes.
+      """
+      def bypath():
+         seq = 0
+         for i,hfn in enumerate(self.hashfiles):
+            for h,p in _indexlines(hfn,valid=_hexdigest_re(hfn)):
+               seq += 1
+               yield '{}\0{:012d}\0{}\0{}\n'.format(p,seq,i,h)
+      def byhash():
+         for p, lines in groupby(_external_sort(bypath(),mem_limit),key=lambda l: l.split('\0',1)[0]):
+            last = {}
+            for line in lines:
+               _,_,i,h = line.rstrip('\n').split('\0')
+               last[int(i)] = h
+            #combine hashes from different .remdups_x.y
+            h = ''.join([last[i] for i in sorted(last) if last[i] != '-'])
+            if h:
+               yield '{}\0{}\n'.format(h,p)
+      for h, lines in groupby(_external_sort(byhash(),mem_limit),key=lambda l: l.split('\0',1)[0]):
+         yield h, [line.rstrip('\n').split('\0',1)[1] for line in lines]
+   def join(self,index,mem_limit):
+      """Yields (hash,present,paths) for the files of index, a .remdups_x.y built independently,
+      e.g. on a backup host, with paths relative to its folder, which is treated like <fromdir>.
+      present are the paths with the same hash in the .remdups_x.y of the same name here.
+      Both files are sorted on disk by hash, using about mem_limit bytes, and merged.
+      """
+      hfn = os.path.basename(index)
+      if hfn not in self.hashfiles:
+         raise ValueError(hfn+' is needed here to join with '+index)
+      nfromdir = self.relpath(os.path.dirname(index) or '.')
+      fixfromdir = _fixfromdir(nfromdir)
+      topath = lambda p: fixfromdir(joinp(nfromdir,normp(p)))
+      for joined in _mergejoin(_sortedindex(hfn,mem_limit),_sortedindex(index,mem_limit,topath)):
+         yield joined
+   def compact(self):
+      """Rewrites the .remdups_ files without the entries of files that do not exist any more,
+      and without replaced or removed lines. Returns the number of dropped lines."""
+      self.update_hashfiles()
+      dropped = 0
+      isfile = lambda p: os.path.isfile(_memberof(p) or p)
+      for fn,exists in ([(hfn,isfile) for hfn in self.hashfiles+[Hasher.phashfile,Hasher.sizefile]]
+            +[(Hasher.dirsfile,os.path.isdir)]):
+         if not os.path.exists(fn):
+            continue
+         lines = defaultdict(int)
+         kept = _atomic_write(fn,('{}\t{}\n'.format(v,p) for p,v in _readindex(fn,lines).items() if exists(p)))
+         dropped += lines[fn]-kept
+      if os.path.exists(Hasher.verifiedfile):
+         lines = 0
+         with open(Hasher.verifiedfile,'r',encoding='utf-8') as f:
+            for line in f:
+               lines += 1
+         def valid(sig):
+            try:
+               return _signature(sig[0]) == sig
+            except OSError:
+               return False
+         keep = (json.dumps([same,sig1,sig2])+'\n' for (sig1,sig2),same in _readverified(Hasher.verifiedfile).items()
+               if valid(sig1) and valid(sig2))
+         dropped += lines-_atomic_write(Hasher.verifiedfile,keep)
+      return dropped
+   def import_sums(self,manifest,source='c'):
+      """Adds the entries of a sha256sum, md5sum,... or BSD style manifest to the .remdups_x.y file.
+      Paths are taken relative to the manifest's directory, which is treated like <fromdir> of update.
+      Only existing files are added. Returns the paths not found."""
+      hfn = sums_hashfile(manifest,source)
+      if [h for h in self.hashfiles if h != hfn]:
+         raise ValueError(hfn+' must be the only .remdups_ hash file to import into')
+      i = self.hashfiles.index(hfn)
+      mdir = os.path.dirname(manifest) or '.'
+      nfromdir = self.relpath(mdir)
+      fixfromdir = _fixfromdir(nfromdir)
+      missing = []
+      for algo,h,p in _parse_sums(manifest):
+         if remdupsfile(source,algo) != hfn:
+            raise ValueError('Different checksum types in '+manifest)
+         if os.path.isabs(p):
+            p = os.path.relpath(p,mdir)
+         path = joinp(nfromdir,normp(p))
+         if path in self.path_hash or fixfromdir(path) in self.path_hash:
+            continue
+         try:
+            isfile = stat.S_ISREG(os.stat(path).st_mode)
+         except OSError:
+            isfile = False
+         if not isfile:
+            missing.append(path)
+            continue
+         self.path_hash[path] = h
+         self.hash_paths[h].append(path)
+         self.hashes2write[i].append((h,path))
+         if len(self.hashes2write[i]) >= 10000:
+            self.update_hashfiles(mdir)
+      self.update_hashfiles(mdir)
+      return missing
+   def export_sums(self,hashfile=None,bsd=False):
+      """yields the lines of a .remdups_c.y file in sha256sum, md5sum,... or BSD style.
+      Only the current hash of each path is exported, not replaced or removed ones,
+      and not the files in archives (archive::member)."""
+      if hashfile is None:
+         hashfile = ([h for h in self.hashfiles if h.startswith('.remdups_c.')] or [None])[0]
+      if hashfile is None or not os.path.basename(hashfile).startswith('.remdups_c.'):
+         raise ValueError('Only (c)ontent hashes can be exported')
+      algo = hashfile.split('.')[-1]
+      for p,h in _readindex(hashfile,valid=_hexdigest_re(hashfile)).items():
+         if _memberof(p):
+            continue
+         p = normp(p).replace(os.sep,'/')
+         if bsd:
+            yield '{} ({}) = {}'.format(algo.upper(),p,h)
+         elif '\\' in p or '\n' in p:
+            yield '\\{}  {}'.format(h,p.replace('\\','\\\\').replace('\n','\\n'))
+         else:
+            yield '{}  {}'.format(h,p)
    def _make_hash_paths(self):
       for apth, ahsh in self.path_hash.items():
          self.hash_paths[ahsh].append(apth)
@@ -211,6 +1346,10 @@ class Hasher:
          sub = normp(f_or_substr)
       else:
          sub = f_or_substr
+      #a path as recorded or relative to . is looked up, not searched
+      for key in [sub,joinp('.',normp(sub))]:
+         if key in self.path_hash:
+            return [p for p in self.hash_paths[self.path_hash[key]] if p != key]
       _hash = [h for p, h in self.path_hash.items() if sub in p]
       if not _hash or len(_hash) > 1:
          raise ValueError('Path does not (uniquely) define a file')
@@ -228,19 +1367,35 @@ class Hasher:
             ii = [i for i,(_,p) in enumerate(w) if p == repth]
             for i in reversed(ii):
                del w[i]
+         self.path_phash.pop(repth,None)
+         self.phash2write = [(h,p) for h,p in self.phash2write if p != repth]
+         self.path_size.pop(repth,None)
+         self.size2write = [(z,p) for z,p in self.size2write if p != repth]
       else:
          self.hashes2write = defaultdict(list)
          self.path_hash = defaultdict(str)
          self.hash_paths = defaultdict(list)
+         self.dirs2write = []
+         self.dir_stamp = {}
+         self.path_phash = {}
+         self.phash2write = []
+         self.path_size = {}
+         self.size2write = []
+         self.lines = self.stale = 0
    def hash(self,repth,content=None):
+      self._record(repth,*self._digests(repth,content))
+   def _digests(self,repth,content=None,member=None,phash=True):
+      """returns the hashes of repth for the .remdups_x.y files and its perceptual hash or None.
+      member is (open,size,mtime) of an archive member, see _members(), with the virtual path repth.
+      """
       #repth='__init__.py'
-      blocksize = filecmp.BUFSIZE
+      blocksize = Hasher.readsize
       hashers = dict()
       sm = [[s,getattr(hashlib,m)()] for hf in self.hashfiles for s,m in [re.split('_|\.',hf)[2:]]]
       if any([s.startswith('e') for s,m in sm]):#exif
          try:
             from PIL import Image
-            img = Image.open(repth)
+            img = Image.open(member[0]() if member else repth)
             exif_data = _encode(str(img._getexif()))
             #exif_data = b"{'a':''}",len(exif_data)
             if len(exif_data) < 8:
@@ -253,38 +1408,66 @@ class Hasher:
                if sm[i][0].startswith('e'):
                   sm[i][0] = 'c'
       if any([s.startswith('c') or s.startswith('b') for s,m in sm]):#content,block
-         with open(repth, 'rb') as _file:
-            #_file=open(repth,'rb')
-            #_file.close()
-            buf = _file.read(blocksize)
+         if member:
+            reader = _readall(member[0](),blocksize,self.throttle)
+         else:
+            reader = _blocks(repth,blocksize,self.direct,self.throttle)
+         try:
+            buf = next(reader,b'')
             if content!=None: content.append(buf)
+            hascontent = any([s.startswith('c') for s,m in sm])
             while len(buf) > 0:
                for s,m in sm:
                   #s,m=sm[0]
-                  if s.startswith('c') or s.startswith('b'):
+                  if s.startswith('c'):
                      m.update(buf)
-               if not any([s.startswith('c') for s,m in sm]):#no content
+                  elif s.startswith('b'):
+                     #as with filecmp.BUFSIZE reads: the whole file along with (c)ontent, else the first block
+                     m.update(hascontent and buf or buf[:filecmp.BUFSIZE])
+               if not hascontent:#no content
                   if content!=None: content.clear()
                   break
-               buf = _file.read(blocksize)
+               buf = next(reader,b'')
                if content!=None: content.append(buf)
+         finally:
+            reader.close()
+      if any([s.startswith('s') for s,m in sm]):#sampled
+         if self.throttle is not None and not any([s.startswith('c') or s.startswith('b') for s,m in sm]):
+            self.throttle.take('files')
+         if member:
+            chunks = _stream_samples(_readall(member[0](),1<<16,self.throttle),member[1],Hasher.samples,Hasher.samplesize)
+         else:
+            chunks = _samples(repth,Hasher.samples,Hasher.samplesize,self.throttle)
+         for chunk in chunks:
+            for s,m in sm:
+               if s.startswith('s'):
+                  m.update(chunk)
       if any([s.startswith('n') for s,m in sm]):#name
          name = _fnencode(os.path.split(repth)[1])
          for s,m in sm:
             if s.startswith('n'):
                m.update(name)
       if any([s.startswith('d') for s,m in sm]):#modification date
-         mtime = _encode(str(os.path.getmtime(repth)))
+         mtime = _encode(str(member[2] if member else os.path.getmtime(repth)))
          for s,m in sm:
             if s.startswith('d'):
                m.update(mtime)
       hshs = [m.hexdigest() for s,m in sm]
+      size = member[1] if member else os.path.getsize(repth)
+      return hshs, phash and self.phash and not member and _dhash(repth) or None, size
+   def _record(self,repth,hshs,phsh=None,size=None):
       ahsh = ''.join(hshs)
       self.path_hash[repth] = ahsh
       self.hash_paths[ahsh].append(repth)
       for i,hsh in enumerate(hshs):
          #i,hsh = 0,hshs[0]
          self.hashes2write[i].append((hsh,repth))
+      if phsh:
+         self.path_phash[repth] = phsh
+         self.phash2write.append((phsh,repth))
+      if size is not None:
+         self.path_size[repth] = size
+         self.size2write.append((size,repth))
 
 def resort(newdir,scheme="%y%m/%d_%H%M%S"):
    "resort according to scheme in newdir, ignoring duplicates"
@@ -357,7 +1540,8 @@ def fn2dirfn(fn,srt=''):
    _,ext = os.path.splitext(fn)
    treesep = os.sep*2
    if srt:
-      mtime = time.localtime(os.stat(fn).st_mtime)
+      #of the archive for a virtual path archive::member
+      mtime = time.localtime(os.stat(_memberof(fn) or fn).st_mtime)
       #time.strftime(srt,time.struct_time((2018,3,2,9,8,7,6,5,4)))
       newfn = joinp('.',normp(time.strftime(srt,mtime))+ext)
    elif treesep in fn:
@@ -367,13 +1551,217 @@ def fn2dirfn(fn,srt=''):
    newdir,_ = os.path.split(newfn)
    return normp(fn),newdir,newfn
 
+class _Inotify:
+   "minimal linux inotify via ctypes"
+   IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+   IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+   IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+   mask = IN_MODIFY|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE
+   def __init__(self):
+      import ctypes, ctypes.util
+      try:
+         self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+         self.fd = self.libc.inotify_init()
+      except (OSError, AttributeError, TypeError):
+         raise OSError('inotify not available')
+      if self.fd < 0:
+         raise OSError(ctypes.get_errno(),'inotify_init failed')
+      self.wds = {}
+   def add(self,dirpath):
+      wd = self.libc.inotify_add_watch(self.fd,_fnencode(dirpath),_Inotify.mask)
+      if wd >= 0:
+         self.wds[wd] = dirpath
+   def read(self,timeout):
+      "yields (mask,path) of the events within timeout seconds"
+      import select, struct
+      if not select.select([self.fd],[],[],timeout)[0]:
+         return
+      buf = os.read(self.fd,1<<16)
+      i = 0
+      while i < len(buf):
+         wd,mask,cookie,n = struct.unpack_from('iIII',buf,i)
+         name = buf[i+16:i+16+n].rstrip(b'\0').decode(_fnencoding,'surrogateescape')
+         i += 16+n
+         if mask & _Inotify.IN_IGNORED:
+            self.wds.pop(wd,None)
+         elif mask & _Inotify.IN_Q_OVERFLOW:
+            yield mask,None
+         elif wd in self.wds:
+            yield mask,joinp(self.wds[wd],name)
+   def close(self):
+      os.close(self.fd)
+
+def _pooled(fn,items,jobs):
+   "yields fn(item) in order, with at most jobs threads and a bounded number of pending items"
+   if jobs <= 1:
+      for item in items:
+         yield fn(item)
+      return
+   with ThreadPoolExecutor(jobs) as pool:
+      pending = deque()
+      for item in items:
+         pending.append(pool.submit(fn,item))
+         if len(pending) >= 4*jobs:
+            yield pending.popleft().result()
+      while pending:
+         yield pending.popleft().result()
+
+def _server_address(address):
+   "('host',port) for [host]:port, else the path of a unix socket"
+   host, sep, port = address.rpartition(':')
+   if sep and port.isdigit():
+      return (host or '127.0.0.1', int(port))
+   return address
+
+def query_server(address,**request):
+   "sends the request to a 'remdups serve' at address and returns its result"
+   address = _server_address(address)
+   if not isinstance(address,tuple) and not hasattr(socket,'AF_UNIX'):
+      raise ValueError('No unix sockets here: use an address [host]:port')
+   family = isinstance(address,tuple) and socket.AF_INET or socket.AF_UNIX
+   with socket.socket(family,socket.SOCK_STREAM) as sock:
+      sock.connect(address)
+      with sock.makefile('rw',encoding='utf-8') as f:
+         f.write(json.dumps(request)+'\n')
+         f.flush()
+         answer = json.loads(f.readline())
+   if 'error' in answer:
+      raise ValueError(answer['error'])
+   return answer['result']
+
+class _QueryHandler(socketserver.StreamRequestHandler):
+   "answers each JSON request line with a {'result': ...} or {'error': ...} line"
+   def handle(self):
+      for line in self.rfile:
+         try:
+            answer = {'result': self.server.answer(**json.loads(line.decode('utf-8')))}
+         except Exception as e:
+            answer = {'error': str(e)}
+         self.wfile.write(_encode(json.dumps(answer)+'\n'))
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+   allow_reuse_address = True
+   daemon_threads = True
+
+if hasattr(socketserver,'ThreadingUnixStreamServer'):
+   class _UnixServer(socketserver.ThreadingUnixStreamServer):
+      daemon_threads = True
+else:
+   _UnixServer = None #e.g. on Windows
+
+def _under(path,folders):
+   "whether path is below one of folders"
+   d = os.path.dirname(path)
+   while d:
+      if d in folders:
+         return True
+      parent = os.path.dirname(d)
+      if parent == d:
+         break
+      d = parent
+   return False
+
+class Group:
+   """A group of same files, as yielded by Command.iter_groups().
+   digest is the (combined) hash, size the file size (None if unknown),
+   paths the sorted paths, keep the one to keep and same_tail whether all paths end the same.
+   """
+   __slots__ = ('digest','size','paths','keep','same_tail')
+   def __init__(self,digest,size,paths,keep,same_tail):
+      self.digest = digest
+      self.size = size
+      self.paths = paths
+      self.keep = keep
+      self.same_tail = same_tail
+   def __repr__(self):
+      return 'Group({!r},{!r},{!r},{!r},{!r})'.format(self.digest,self.size,self.paths,self.keep,self.same_tail)
+
 class Command:
 
    SH,BAT,PY = range(3)
 
-   def __init__(self):
-      self.hasher = Hasher()
-      self.hasher.load_hashes()
+   filecommands = {
+      "rm": [
+         'rm -f {0}',
+         'del /F/Q {0}',
+         'remove({0})'
+         ],
+      "cp": [#0,1,2=fn, dest dir, dest full pth
+         'mkdir -p {1} && cp {0} {2}',
+         'echo F|xcopy /Y {0} {2}',
+         'makedirs({1},exist_ok=True);copy2({0}, {2})'
+         ],
+      "mv": [
+         'mkdir -p {1} && mv {0} {2}',
+         'mkdir {1} & move /Y {0} {2}',
+         'makedirs({1},exist_ok=True);move({0}, {2})' #the space is needed (see tocmds())
+         ]
+      }
+   dircommands = {
+      "rm": [
+         'rm -rf {0}',
+         'rmdir /S/Q {0}',
+         'rmtree({0})'
+         ],
+      "cp": [
+         'cp -r {0} {2}',
+         'xcopy /I/Y/S {0} {2}',
+         'copytree({0}, {2})'
+         ],
+      "mv": [
+         'mv {0} {2}',
+         'move /Y {0} {2}\\',
+         'move({0}, {2})'
+         ]
+      }
+
+   #with --batch: multi-argument commands for files ({0}) and folders ({1}), None if not possible
+   batchcommands = {
+      "rm": [
+         ('rm -f -- {args}','rm -rf -- {args}'),
+         ('del /F/Q {args}','rmdir /S/Q {args}'),
+         None
+         ],
+      "cp": [
+         ('mkdir -p {dir} && cp -- {args} {dir}','mkdir -p {dir} && cp -r -- {args} {dir}'),
+         None,
+         None
+         ],
+      "mv": [
+         ('mkdir -p {dir} && mv -- {args} {dir}','mkdir -p {dir} && mv -- {args} {dir}'),
+         None,
+         None
+         ]
+      }
+   #command line length limits (well below ARG_MAX and cmd.exe's 8191)
+   batchlimit = [65536, 8000, 0]
+   #update compacts, if more than this part of the lines are replaced or removed ones
+   compact_ratio = 0.5
+
+   pyheader = ["",
+      "from shutil import *",
+      "from os import *",
+      "xmove = lambda x,y: makedirs(y+sep,exist_ok=True) and copy2(x,y)",
+      "xcopy = lambda x,y: makedirs(y+sep,exist_ok=True) and move(x,y)",
+      "def remove_empty_dirs(pth):",
+      "   for f in listdir(pth):",
+      "      p = path.join(pth, f)",
+      "      if path.isdir(p):",
+      "         remove_empty_dirs(p)",
+      "   if not listdir(pth):",
+      "      try:",
+      "         rmdir(pth)",
+      "      except: pass",
+      ]
+
+   def __init__(self,defaulthashfile='.remdups_c.sha256',load=True):
+      self.hasher = Hasher(defaulthashfile)
+      self.same_dirs = []
+      self.similar = []
+      self.present = []
+      self.forcekeep = set()
+      if load:
+         self.hasher.load_hashes()
 
    def init_command(self,**args):
       win32 = sys.platform=='win32'
@@ -395,40 +1783,8 @@ class Command:
             lambda fn:  '"' + fn + '"',
             lambda fn:  'r"' + fn + '"',
             ]
-      filecommand = {
-         "rm": [
-            'rm -f {0}',
-            'del /F/Q {0}',
-            'remove({0})'
-            ],
-         "cp": [#0,1,2=fn, dest dir, dest full pth
-            'mkdir -p {1} && cp {0} {2}',
-            'echo F|xcopy /Y {0} {2}',
-            'makedirs({1},exist_ok=True);copy2({0}, {2})'
-            ],
-         "mv": [
-            'mkdir -p {1} && mv {0} {2}',
-            'mkdir {1} & move /Y {0} {2}',
-            'makedirs({1},exist_ok=True);move({0}, {2})' #the space is needed (see tocmds())
-            ]
-         }
-      dircommand = {
-         "rm": [
-            'rm -rf {0}',
-            'rmdir /S/Q {0}',
-            'rmtree({0})'
-            ],
-         "cp": [
-            'cp -r {0} {2}',
-            'xcopy /I/Y/S {0} {2}',
-            'copytree({0}, {2})'
-            ],
-         "mv": [
-            'mv {0} {2}',
-            'move /Y {0} {2}\\',
-            'move({0}, {2})'
-            ]
-         }
+      filecommand = Command.filecommands
+      dircommand = Command.dircommands
       comment = [
             "#",
             "REM ",
@@ -442,6 +1798,10 @@ class Command:
       self.getarg = lambda x,default=[]: x in self.args and getattr(self.args,x) or default
 
       self.sort = self.getarg('sort','')
+      self.formatpath = formatpath[scripttype]
+      self.batches = {}
+      self.batch = (self.getarg('batch',False) and not self.sort
+            and Command.batchcommands.get(self.args.cmd,[None]*3)[scripttype])
       if self.args.cmd == 'rm':
          self.filecommand = lambda f: filecommand[self.args.cmd][scripttype].format(formatpath[scripttype](f))
          self.dircommand = lambda f: dircommand[self.args.cmd][scripttype].format(formatpath[scripttype](f))
@@ -472,10 +1832,56 @@ class Command:
    def groups(self):
       '''add to self two list of groups of same files: no_same_tail, with_same_tail.
       If not all files in a group have the same tail, then this group is in the no_same_tail list.
+      With mem_limit, the groups are formed by sorting on disk and are kept in temporary files.
+      With from_index (cp, mv), the groups are the files of that index, see Hasher.join(),
+      and those already here go to self.present.
       '''
-      
-      dups = [paths for h, paths in self.hasher.hash_paths.items() if len(paths) > 1]
+      mem_limit = self.getarg('mem_limit',None)
+      from_index = self.getarg('from_index',None)
+      self.present = []
+      if from_index:
+         store = _Spill
+         self._singles, self.present = _Spill(), _Spill()
+         def joined():
+            for h, present, paths in self.hasher.join(from_index,parse_size(mem_limit or '64M')):
+               #not the ones from a <fromdir>
+               present = [p for p in present if os.sep*2 not in p]
+               if present:
+                  self.present.append((present[0],paths))
+               elif len(paths) > 1:
+                  yield paths
+               else:
+                  self._singles.append(('',paths))
+         dups = joined()
+      elif mem_limit:
+         store = _Spill
+         self._singles = _Spill()
+         def external_dups():
+            for h, paths in self.hasher.external_groups(parse_size(mem_limit)):
+               if len(paths) > 1:
+                  yield paths
+               elif self.args.cmd != 'rm':
+                  self._singles.append(('',paths))
+         dups = external_dups()
+      else:
+         store = list
+         dups = (paths for h, paths in self.hasher.hash_paths.items() if len(paths) > 1)
+      top = self.getarg('top',None)
+      if top:
+         dups = heapq.nlargest(top,dups,key=self._reclaimable)
 
+      direct = self.getarg('direct',False)
+      throttle = _throttle(vars(self.args))
+      safe = self.getarg('safe')
+      verified = safe and _readverified(Hasher.verifiedfile) or {}
+      newverified = []
+      def compare(first,other):
+         "samecontent(), unless the files were compared already, unchanged since (.remdups_verified)"
+         key = tuple(sorted([_signature(first),_signature(other)]))
+         if key not in verified:
+            verified[key] = samecontent(first, other, direct, throttle)
+            newverified.append(json.dumps([verified[key],key[0],key[1]])+'\n')
+         return verified[key]
       def safe_cmp(tail_files):
          '''form groups based on bytewise comparison'''
          for tail, paths in tail_files:
@@ -486,7 +1892,7 @@ class Command:
                this.append(first)
                for other in paths[1:]:
                   try:
-                     same = filecmp.cmp(first, other, False)
+                     same = compare(first, other)
                   except (OSError, IOError): # pragma: no cover
                      same = True # pragma: no cover
                   if same:
@@ -498,18 +1904,115 @@ class Command:
                   cnt += 1
                paths = new
 
-      tail_paths = [(_same_tail(paths), paths) for paths in dups]
-      self.no_same_tail = None
       only_same_name = self.getarg('only_same_name')
-      safe = self.getarg('safe')
+      no_same_tail, self.with_same_tail = store(), store()
+      for paths in dups:
+         tail = _same_tail(paths)
+         if tail != '':
+            self.with_same_tail.append((tail, paths))
+         elif not only_same_name:
+            no_same_tail.append((tail, paths))
+      self.no_same_tail = None
       if not only_same_name:
-         self.no_same_tail = [(tail,paths) for tail, paths in tail_paths if not tail]
+         self.no_same_tail = no_same_tail
          if safe:
-            self.no_same_tail = list(safe_cmp(self.no_same_tail))
-      self.with_same_tail = [(tail, paths)
-            for tail, paths in tail_paths if tail != '']
+            self.no_same_tail = store(safe_cmp(self.no_same_tail))
       if safe:
-         self.with_same_tail = list(safe_cmp(self.with_same_tail))
+         self.with_same_tail = store(safe_cmp(self.with_same_tail))
+      if newverified:
+         _repair_tail(Hasher.verifiedfile)
+         with open(Hasher.verifiedfile,'a',encoding='utf-8') as f:
+            f.writelines(newverified)
+      self.same_dirs = []
+      self.forcekeep = set()
+      if self.getarg('dirs') and not mem_limit and not from_index and not self.sort and self.args.cmd in ['rm','cp','mv']:
+         self.same_dirs = self.dirgroups()
+         removed, kept = set(), set()
+         for tail, paths, actions in self.decide(self.same_dirs,True):
+            keep = self._keep(paths)
+            if self.args.cmd == 'rm':
+               removed.update([pth for mark, pth, h in actions if mark == ''])
+               kept.add(keep)
+            elif ('',keep,None) in actions:#copied with all the same folders
+               removed.update(paths)
+         def outside(tail_paths):
+            for tail, paths in tail_paths:
+               if self.args.cmd == 'rm':
+                  paths = [p for p in paths if not _under(p,removed)]
+                  self.forcekeep.update([p for p in paths if _under(p,kept)])
+               elif [p for p in paths if _under(p,removed)]:
+                  continue
+               if len(paths) > 1:
+                  yield tail, paths
+         if self.no_same_tail:
+            self.no_same_tail = store(outside(self.no_same_tail))
+         self.with_same_tail = store(outside(self.with_same_tail))
+      self.similar = []
+      similar = self.getarg('similar',None)
+      if similar is not None and not mem_limit and self.args.cmd == 'rm':
+         self.similar = self.similargroups(similar)
+
+   def similargroups(self,k):
+      '''list of (tail,images) with perceptual hashes (.remdups_p.dhash) within hamming distance k.
+      Of each group of same files only the kept one is taken.
+      The largest file of similar images is kept.
+      '''
+      path_phash = self.hasher.path_phash
+      reps = [self._keep(paths) for t,paths in (self.no_same_tail or [])+(self.with_same_tail or [])]
+      reps += [paths[0] for h,paths in self.hasher.hash_paths.items() if len(paths) == 1]
+      phash_paths = defaultdict(list)
+      for p in reps:
+         if p in path_phash:
+            phash_paths[int(path_phash[p],16)].append(p)
+      tree = BKTree(phash_paths)
+      done = set()
+      groups = []
+      for ph in sorted(phash_paths):
+         if ph in done:
+            continue
+         near = [v for d,v in tree.query(ph,k) if v not in done]
+         done.update(near)
+         paths = sorted([p for v in near for p in phash_paths[v]])
+         if len(paths) > 1:
+            self.forcekeep.add(max(paths,key=lambda p: (os.path.getsize(p),-len(p))))
+            groups.append((_same_tail(paths),paths))
+      return groups
+
+   def dirgroups(self):
+      '''list of (tail,folders) of folders with the same files, the ones with most files first.
+      Only folders whose entries are all in the index are taken, and not those within such folders.
+      Folders with a file that is commented out (--comment-out, saved html files) are not taken.
+      '''
+      dir_hash, dir_files, dir_entries = self.hasher.merkle()
+      complete = {}
+      protected = lambda p: _memberof(p) or any([cmnt(p) for cmnt in self.comment_outs])
+      def iscomplete(d):
+         if d not in complete:
+            try:
+               listed = set(os.listdir(d))
+            except OSError:
+               listed = None
+            complete[d] = (listed == set([n for n,sub in dir_entries[d]])
+                  and not any([protected(joinp(d,n)) for n,sub in dir_entries[d] if not sub])
+                  and all([iscomplete(sub) for n,sub in dir_entries[d] if sub]))
+         return complete[d]
+      #only folders below <fromdir> or .
+      movable = lambda d: os.sep*2 in d or d.startswith('.'+os.sep)
+      byhash = defaultdict(list)
+      for d,h in dir_hash.items():
+         if movable(d):
+            byhash[h].append(d)
+      dups = {}
+      for h,ds in byhash.items():
+         ds = len(ds) > 1 and [d for d in ds if iscomplete(d)] or []
+         if len(ds) > 1:
+            dups.update([(d,h) for d in ds])
+      outer = defaultdict(list)
+      for d,h in dups.items():
+         if os.path.dirname(d) not in dups:
+            outer[h].append(d)
+      groups = [(_same_tail(ds), sorted(ds)) for h,ds in outer.items() if len(ds) > 1]
+      return sorted(groups,key=lambda tp: (-dir_files[tp[1][0]],tp[1]))
 
    def _html_files(self,filename):
       '''check whether filename is a saved html file'''
@@ -521,41 +2024,107 @@ class Command:
                or os.path.exists(filename + '.htm'))
          return res
 
-   def gen_command(self,tail_paths):
-      '''yield all commands'''
-      c = self.comment
+   def _size(self,path):
+      "size of path from .remdups_size, else from the file system, None if not there"
+      size = self.hasher.path_size.get(path)
+      if size is None:
+         try:
+            size = os.path.getsize(normp(path))
+         except OSError:
+            pass
+      return size
+   def _reclaimable(self,paths):
+      "bytes freed by keeping only one of the same files"
+      return (self._size(paths[0]) or 0)*(len(paths)-1)
+   def _keep(self,paths):
+      "take the shortest path in the smallest set"
+      forced = sorted([p for p in paths if p in self.forcekeep])
+      if forced:
+         return forced[0]
+      #not a file in an archive, if possible
+      paths = [p for p in paths if not _memberof(p)] or paths
       lenk = lambda x: len(x)
       equal = lambda x: x
       tokeep = self.keepers + [equal]
+      return sorted(filter(equal,
+         [sorted(kp(paths), key=lenk) for kp in tokeep]), key=lenk)[0][0]
+
+   def decide(self,tail_paths,isdir=False):
+      """yield (tail,paths,actions) with actions a list of (mark,path,htmlfiles).
+      mark is '' for do, '>' for not to do and 'c' for commented out.
+      htmlfiles is the folder belonging to a .htm(l) file or None.
+      """
       html_files_suffix = self.getarg('html_files_suffix','_files')
       for tail, paths in tail_paths:
-         if len(paths) > 1:
-            yield ''
-            yield c+':#' + tail + '{{{'
-         # take the shortest path in the smallest set
-         keep = sorted(filter(equal,
-            [sorted(kp(paths), key=lenk) for kp in tokeep]), key=lenk)[0][0]
+         keep = self._keep(paths)
+         actions = []
          for pth in sorted(paths):
-            if self.args.cmd == 'rm':
-               cc = ''
+            if self.args.cmd in ['rm','link']:
+               mark = ''
             else:
-               cc = c+'>#'
+               mark = '>'
             if pth == keep:
-               if self.args.cmd == 'rm':
-                  cc = c+'>#'
+               if self.args.cmd in ['rm','link']:
+                  mark = '>'
                else:
-                  cc = ''
-            if any([cmnt(pth) for cmnt in self.comment_outs]):
-               cc = c+'c#'
-            yield cc+self.filecommand(pth)
+                  mark = ''
+            if any([cmnt(pth) for cmnt in self.comment_outs]) or _memberof(pth):
+               mark = 'c'
+            htmlfiles = None
             filename, ext = os.path.splitext(pth)
-            if '.htm' in ext:
+            if '.htm' in ext and not isdir:
                htmlfiles = filename + html_files_suffix
-               if os.path.exists(htmlfiles):
-                  yield cc+self.dircommand(htmlfiles)
+               if not os.path.exists(htmlfiles):
+                  htmlfiles = None
+            actions.append((mark,pth,htmlfiles))
+         yield tail, paths, actions
+
+   def gen_command(self,tail_paths,isdir=False):
+      '''yield all commands'''
+      c = self.comment
+      command = isdir and self.dircommand or self.filecommand
+      for tail, paths, actions in self.decide(tail_paths,isdir):
+         if len(paths) > 1:
+            yield ''
+            yield c+':#' + tail + '{{{'
+         for mark, pth, htmlfiles in actions:
+            if not mark and self.batch:
+               #=# is done by the batch commands at the end of the section
+               mark = '='
+               self.add_batch(isdir,pth)
+               if htmlfiles:
+                  self.add_batch(True,htmlfiles)
+            cc = mark and c+mark+'#' or ''
+            yield cc+command(pth)
+            if htmlfiles:
+               yield cc+self.dircommand(htmlfiles)
          if len(paths) > 1:
             yield c+':#}}}'
 
+   def add_batch(self,isdir,pth):
+      "collect pth for the batch commands, by kind and target folder"
+      if self.args.cmd == 'rm':
+         key, arg = (isdir,''), pth
+      else:
+         arg, newdir, newfn = fn2dirfn(pth)
+         key = (isdir,newdir)
+      self.batches.setdefault(key,[]).append(self.formatpath(arg))
+   def batched(self):
+      "yields the batch commands for what add_batch() collected, each below the length limit"
+      limit = Command.batchlimit[self.scripttype]
+      for (isdir,newdir),args in self.batches.items():
+         template = self.batch[isdir]
+         fd = newdir and self.formatpath(newdir)
+         line, n = [], len(template)+2*len(fd)
+         for arg in args:
+            #n is the length with ' '.join(line+[arg])
+            if line and n+len(arg) > limit:
+               yield template.format(dir=fd,args=' '.join(line))
+               line, n = [], len(template)+2*len(fd)
+            line.append(arg)
+            n += len(arg)+1
+         yield template.format(dir=fd,args=' '.join(line))
+      self.batches = {}
    def out(self,output):
       def _genout(output):
          for grp in output:
@@ -566,14 +2135,16 @@ class Command:
             else:
                yield grp
       if 'script' in self.args and self.args.script != None:
-         self.args.script.write('\n'.join([o for o in _genout(output)]))
+         #line by line, not to hold all of them
+         for i,o in enumerate(_genout(output)):
+            self.args.script.write(i and '\n'+o or o)
          if self.args.script != sys.stdout:
             self.args.script.close()
 
    def commands(self):
+      "yields the lines of the script"
       self.groups()
       c = self.comment
-      cmds = []
       tcnt=defaultdict(int)
       def tocmds(line):
          if self.sort and self.args.cmd != 'rm' and line and not line.startswith(self.comment):
@@ -586,132 +2157,559 @@ class Command:
                lprts[-1] = sl1+'_'+str(lpc)+sl2
             tcnt[lp1]+=1
             line = ' '.join(lprts)
-         cmds.append(line)
-      if self.no_same_tail or self.with_same_tail:
-         cmds.append(c+'## vim: set fdm=marker')
+         return line
+      if self.no_same_tail or self.with_same_tail or self.same_dirs or self.similar or self.present:
+         yield c+'## vim: set fdm=marker'
       if self.scripttype == Command.PY:
-         cmds.extend(["",
-                  "from shutil import *",
-                  "from os import *",
-                  "xmove = lambda x,y: makedirs(y+sep,exist_ok=True) and copy2(x,y)",
-                  "xcopy = lambda x,y: makedirs(y+sep,exist_ok=True) and move(x,y)",
-                  "def remove_empty_dirs(pth):",
-                  "   for f in listdir(pth):",
-                  "      p = path.join(pth, f)",
-                  "      if path.isdir(p):",
-                  "         remove_empty_dirs(p)",
-                  "   if not listdir(pth):",
-                  "      try:",
-                  "         rmdir(pth)",
-                  "      except: pass",
-                  ])
-      if self.no_same_tail:
-         cmds.append('')
-         cmds.append(c+'## No Same Tail {{{')
-         for line in self.gen_command(self.no_same_tail):
-            tocmds(line)
-         cmds.append(c+'## }}}')
-      if self.with_same_tail:
-         cmds.append('')
-         cmds.append(c+'## With Same Tail {{{')
-         for line in self.gen_command(self.with_same_tail):
-            tocmds(line)
-         cmds.append(c+'## }}}')
+         for line in Command.pyheader:
+            yield line
+      for title, tail_paths, isdir in [
+            ('Same Folders',self.same_dirs,True),
+            ('No Same Tail',self.no_same_tail,False),
+            ('With Same Tail',self.with_same_tail,False),
+            ('Similar Images',self.similar,False)]:
+         if tail_paths:
+            yield ''
+            yield c+'## '+title+' {{{'
+            for line in self.gen_command(tail_paths,isdir):
+               yield tocmds(line)
+            for line in self.batched():
+               yield line
+            yield c+'## }}}'
+      if self.present:
+         #with --from-index: the files there that are here already
+         yield ''
+         yield c+'## Already Present {{{'
+         for here, paths in self.present:
+            yield ''
+            yield c+':#' + here + '{{{'
+            for pth in sorted(paths):
+               yield c+'>#'+self.filecommand(pth)
+            yield c+':#}}}'
+         yield c+'## }}}'
       if self.args.cmd == 'rm':
          #remove empty folders
          if self.scripttype==Command.BAT:
-            cmds.append('''for /f "delims=" %%d in ('dir /s /b /ad ^| sort /r') do rd "%%d"''')
-            cmds.append('exit /B 0')
+            yield '''for /f "delims=" %%d in ('dir /s /b /ad ^| sort /r') do rd "%%d"'''
+            yield 'exit /B 0'
          elif self.scripttype==Command.SH:
-            cmds.append('''find . -type d -empty -delete''')
+            yield '''find . -type d -empty -delete'''
          elif self.scripttype==Command.PY:
-            cmds.append('')
-            cmds.append('''remove_empty_dirs('.')''')
+            yield ''
+            yield '''remove_empty_dirs('.')'''
       if self.args.cmd != 'rm':
-         for line in self.gen_command([('',paths) for h, paths in self.hasher.hash_paths.items() if len(paths) == 1]):
-            tocmds(line)
+         for line in self.gen_command(self.singles()):
+            yield tocmds(line)
+         for line in self.batched():
+            yield line
+
+   def write_commands(self):
+      """writes the commands() to the script and returns them as list.
+      With mem_limit, they are written as they come, not to hold them, and None is returned.
+      """
+      if self.getarg('mem_limit',None) and self.getarg('script',None) is not None:
+         self.out(self.commands())
+         return None
+      cmds = list(self.commands())
       self.out(cmds)
       return cmds
 
+   def singles(self):
+      "files without duplicate, as (tail,paths) like the groups"
+      if self.getarg('mem_limit',None) or self.getarg('from_index',None):
+         return self._singles
+      return [('',paths) for h, paths in self.hasher.hash_paths.items() if len(paths) == 1]
+
+   def execute(self):
+      '''Apply the commands in-process instead of writing a script.
+      Target folders are made once. The file operations run on --jobs threads.
+      Returns the journal: the applied commands as lines of a python script.
+      Failed commands are commented out with #!# and the error appended.
+      '''
+      self.groups()
+      cmd = self.args.cmd
+      dryrun = self.getarg('dry_run',False)
+      jobs = self.getarg('jobs',1)
+      journal = self.getarg('journal',None)
+      sections = [(1,self.same_dirs),(0,self.no_same_tail or []),(0,self.with_same_tail or []),(0,self.similar)]
+      if cmd != 'rm':
+         sections.append((0,self.singles()))
+      reflink = self.getarg('reflink',False)
+      apply = {
+            "link": [lambda k,f: relink(k,f,reflink)],
+            "rm": [os.remove, shutil.rmtree],
+            "cp": [lambda f,d,t: shutil.copy2(f,t), lambda f,d,t: shutil.copytree(f,t)],
+            "mv": [lambda f,d,t: shutil.move(f,t), lambda f,d,t: shutil.move(f,t)],
+            }[cmd]
+      madedirs = set()
+      tcnt = defaultdict(int)
+      def ops():
+         for sectionisdir,section in sections:
+            for tail, paths, actions in self.decide(section,sectionisdir):
+               keep = cmd == 'link' and self._keep(paths)
+               for mark, pth, htmlfiles in actions:
+                  if mark:
+                     continue
+                  if keep:
+                     yield 0,(keep,pth)
+                     continue
+                  for isdir,f in [(sectionisdir,pth),(1,htmlfiles)]:
+                     if not f:
+                        continue
+                     if cmd == 'rm':
+                        yield isdir,(f,)
+                        continue
+                     f,newdir,newf = fn2dirfn(f,self.sort)
+                     if self.sort:
+                        n = tcnt[newf]
+                        tcnt[newf] += 1
+                        if n:
+                           sl1,sl2 = os.path.splitext(newf)
+                           newf = sl1+'_'+str(n)+sl2
+                     if newdir not in madedirs:
+                        madedirs.add(newdir)
+                        if not dryrun:
+                           os.makedirs(newdir,exist_ok=True)
+                     yield isdir,(f,newdir,newf)
+      def applyop(op):
+         isdir,fdt = op
+         if cmd == 'link':
+            line = (reflink and 'relink({0}, {1}, True)' or 'relink({0}, {1})').format(*[repr(x) for x in fdt])
+         else:
+            commands = isdir and Command.dircommands or Command.filecommands
+            line = commands[cmd][Command.PY].format(*[repr(x) for x in fdt])
+         if not dryrun:
+            try:
+               apply[isdir](*fdt)
+            except OSError as err:
+               return '#!#'+line+' #'+str(err).replace('\n',' ')
+         return line
+      lines = list(Command.pyheader)
+      if cmd == 'link':
+         lines.append('from remdups import relink')
+      if journal:
+         journal.write('\n'.join(lines)+'\n')
+      for line in _pooled(applyop,ops(),jobs):
+         lines.append(line)
+         if journal:
+            journal.write(line+'\n')
+      if cmd == 'rm':
+         if not dryrun:
+            remove_empty_dirs('.')
+         lines.append("remove_empty_dirs('.')")
+         if journal:
+            journal.write(lines[-1]+'\n')
+      if journal and journal != sys.stdout:
+         journal.close()
+      self.errors = [line for line in lines if line.startswith('#!#')]
+      return lines
+
    def update(self,**args):
       __doc__ = self.hasher.hashall.__doc__
       args['cmd'] = 'update'
+      self.hasher.direct = args.get('direct',False)
+      self.hasher.throttle = _throttle(args)
+      if args.get('resume') and os.path.exists(Hasher.resumefile):
+         with open(Hasher.resumefile,'r',encoding='utf-8') as f:
+            state = json.load(f)
+         args.update(fromdir=state['fromdir'],filter=state['filter'],exclude=state['exclude'],resume_at=state['last'])
       self.hasher.hashall(**args)
+      compact_ratio = args.get('compact_ratio',Command.compact_ratio)
+      if self.hasher.lines and self.hasher.stale > compact_ratio*self.hasher.lines:
+         self.compact()
+   def compact(self,**args):
+      "drop entries of not existing files and replaced lines from the .remdups_* files"
+      args['cmd'] = 'compact'
+      dropped = self.hasher.compact()
+      self.hasher.clear()
+      self.hasher.load_hashes()
+      return dropped
    def rm(self,**args):
       "remove duplicate files"
       args['cmd'] = 'rm'
       self.init_command(**args)
-      return self.commands()
+      if self.getarg('execute') or self.getarg('dry_run'):
+         return self.execute()
+      return self.write_commands()
    def cp(self,**args):
       "copy duplicate files from other directory to here, ignoring duplicates"
       args['cmd'] = 'cp'
       self.init_command(**args)
-      return self.commands()
+      if self.getarg('execute') or self.getarg('dry_run'):
+         return self.execute()
+      return self.write_commands()
    def mv(self,**args):
       "move files from other directory to here, ignoring duplicates"
       args['cmd'] = 'mv'
       self.init_command(**args)
-      return self.commands()
+      if self.getarg('execute') or self.getarg('dry_run'):
+         return self.execute()
+      return self.write_commands()
+   def watch(self,**args):
+      "keep the .remdups_* files up to date with the changes in fromdir"
+      args['cmd'] = 'watch'
+      for changed, deleted in self.hasher.watch(**args):
+         pass
+   def link(self,**args):
+      "replace duplicate files by hardlinks (or reflinks) to the kept one, in-process"
+      args['cmd'] = 'link'
+      self.init_command(**args)
+      return self.execute()
+   def server(self,**args):
+      '''Returns a socketserver at args address (path of a unix socket or [host]:port),
+      answering the JSON requests {"cmd": "dupsof"|"dupsoftail", "substr": ...} and {"cmd": "reload"}
+      from the hashes loaded once.'''
+      args['cmd'] = 'serve'
+      self.init_command(**args)
+      lock = threading.Lock()
+      self.with_same_tail = None
+      def answer(cmd,substr='',**other):
+         with lock:
+            if cmd == 'dupsof':
+               return self.hasher.duplicates(substr)
+            if cmd == 'dupsoftail':
+               if self.with_same_tail is None:
+                  self.groups()
+               return [paths for t, paths in self.with_same_tail if t.endswith(normp(substr))]
+            if cmd == 'reload':
+               self.hasher.clear()
+               self.hasher.load_hashes()
+               self.with_same_tail = None
+               return len(self.hasher.path_hash)
+            raise ValueError('Unknown request '+str(cmd))
+      address = _server_address(self.getarg('address','.remdups_socket'))
+      if isinstance(address,tuple):
+         server = _TCPServer(address,_QueryHandler)
+      elif _UnixServer is None:
+         raise ValueError('No unix sockets here: use an address [host]:port')
+      else:
+         if os.path.exists(address):
+            os.remove(address)
+         server = _UnixServer(address,_QueryHandler)
+      server.answer = answer
+      return server
+   def serve(self,**args):
+      "answer dupsof and dupsoftail queries of 'dupsof --server', loading the hashes only once"
+      server = self.server(**args)
+      try:
+         server.serve_forever()
+      except KeyboardInterrupt:
+         pass
+      finally:
+         server.server_close()
+         if isinstance(server.server_address,str) and os.path.exists(server.server_address):
+            os.remove(server.server_address)
+   def iter_groups(self,**args):
+      """Yields a Group for each group of same files, one by one, without making commands.
+      args are options of rm: keep_in, keep_out, only_same_name and mem_limit.
+      With mem_limit, use Command(load=False): the groups come from sorting the .remdups_ files on disk.
+      """
+      args['cmd'] = 'groups'
+      self.init_command(**args)
+      mem_limit = self.getarg('mem_limit',None)
+      only_same_name = self.getarg('only_same_name')
+      if mem_limit:
+         items = self.hasher.external_groups(parse_size(mem_limit))
+      else:
+         items = self.hasher.hash_paths.items()
+      for digest, paths in items:
+         if len(paths) < 2:
+            continue
+         same_tail = _same_tail(paths) != ''
+         if only_same_name and not same_tail:
+            continue
+         yield Group(digest,self._size(paths[0]),sorted(paths),self._keep(paths),same_tail)
+   def verify(self,**args):
+      "rehash the files in the index and report the ones changed or missing (bit rot)"
+      args['cmd'] = 'verify'
+      self.init_command(**args)
+      self.hasher.direct = self.getarg('direct',False)
+      self.hasher.throttle = _throttle(args)
+      bad = [(status,path) for status,path in self.hasher.verify(self.getarg('part',None),self.getarg('jobs',4))
+            if status != 'ok']
+      self.out(['{}\t{}'.format(status,path) for status,path in bad])
+      return bad
+   def report(self,**args):
+      "duplicate groups as JSON lines, the ones freeing most bytes first"
+      top = args.get('top')
+      groups = ((self._reclaimable(g.paths),g) for g in self.iter_groups(**args))
+      if top:#without sorting all
+         ranked = heapq.nlargest(top,groups,key=lambda rg: rg[0])
+      else:
+         ranked = sorted(groups,key=lambda rg: rg[0],reverse=True)
+      output = [json.dumps(dict(reclaimable=r,size=g.size,digest=g.digest,keep=g.keep,paths=g.paths))
+            for r,g in ranked]
+      self.out(output)
+      return output
+   def dupdirs(self,**args):
+      "folders with the same files, the ones with most files first"
+      args['cmd'] = 'dupdirs'
+      self.init_command(**args)
+      output = [paths for t, paths in self.dirgroups()]
+      self.out(output)
+      return output
    def dupsoftail(self,**args):
       "duplicates having the provided tail"
       args['cmd'] = 'dupsoftail'
       self.init_command(**args)
-      self.groups()
-      output = [paths for t, paths in self.with_same_tail if t.endswith(normp(self.args.substr))]
+      server = self.getarg('server',None)
+      if server:
+         output = query_server(server,cmd='dupsoftail',substr=self.args.substr)
+      else:
+         self.groups()
+         output = [paths for t, paths in self.with_same_tail if t.endswith(normp(self.args.substr))]
       self.out(output)
       return output
    def dupsof(self,**args):
       "duplicates of a provided file name or substring"
       args['cmd'] = 'dupsof'
       self.init_command(**args)
-      output=self.hasher.duplicates(self.args.substr)
+      server = self.getarg('server',None)
+      if server:
+         output = query_server(server,cmd='dupsof',substr=self.args.substr)
+      else:
+         output = self.hasher.duplicates(self.args.substr)
+      self.out(output)
+      return output
+   def import_sums(self,**args):
+      "import a sha256sum, md5sum,... or BSD style checksum manifest into .remdups_c.y, without reading the files"
+      args['cmd'] = 'import'
+      self.init_command(**args)
+      output=self.hasher.import_sums(self.args.manifest)
       self.out(output)
       return output
+   def export_sums(self,**args):
+      "export .remdups_c.y as sha256sum, md5sum,... or BSD style checksum manifest"
+      args['cmd'] = 'export'
+      self.init_command(**args)
+      for line in self.hasher.export_sums(self.getarg('hashfile',None),self.getarg('bsd',False)):
+         self.args.script.write(line+'\n')
+      if self.args.script != sys.stdout:
+         self.args.script.close()
 
 def update(args):
    acommand = Command()
    acommand.update(**vars(args))
 def rm(args):
-   acommand = Command()
+   acommand = Command(load=not args.mem_limit)
    return acommand.rm(**vars(args))
 def cp(args):
-   acommand = Command()
+   acommand = Command(load=not args.mem_limit and not args.from_index)
    return acommand.cp(**vars(args))
 def mv(args):
-   acommand = Command()
+   acommand = Command(load=not args.mem_limit and not args.from_index)
    return acommand.mv(**vars(args))
-def dupsoftail(args):
+def compact(args):
+   acommand = Command()
+   return acommand.compact(**vars(args))
+def watch(args):
+   acommand = Command()
+   acommand.watch(**vars(args))
+def link(args):
+   acommand = Command(load=not args.mem_limit)
+   return acommand.link(**vars(args))
+def verify(args):
+   acommand = Command()
+   return acommand.verify(**vars(args))
+def report(args):
+   acommand = Command(load=not args.mem_limit)
+   return acommand.report(**vars(args))
+def dupdirs(args):
    args.script = argparse.FileType('w')('-')
    acommand = Command()
+   return acommand.dupdirs(**vars(args))
+def serve(args):
+   acommand = Command()
+   return acommand.serve(**vars(args))
+def dupsoftail(args):
+   args.script = argparse.FileType('w')('-')
+   acommand = Command(load=not args.server)
    return acommand.dupsoftail(**vars(args))
 def dupsof(args):
    args.script = argparse.FileType('w')('-')
-   acommand = Command()
+   acommand = Command(load=not args.server)
    return acommand.dupsof(**vars(args))
 
+def import_sums(args):
+   args.script = argparse.FileType('w')('-')
+   acommand = Command(sums_hashfile(args.manifest))
+   return acommand.import_sums(**vars(args))
+def export_sums(args):
+   acommand = Command(load=False)
+   return acommand.export_sums(**vars(args))
+
+def _throttle_args(p,what):
+   p.add_argument(#max_bytes_per_sec
+         '--max-bytes-per-sec', action='store', metavar='SIZE',
+         help='Read at most SIZE (e.g. 50M) per second '+what+', over all threads.')
+   p.add_argument(#max_files_per_sec
+         '--max-files-per-sec', action='store', type=float,
+         help='Open at most this many files per second '+what+', over all threads.')
+   p.add_argument(#adaptive
+         '--adaptive', action='store_true',
+         help='Lower these limits while the read latency rises.')
+
 def parse_args(argv):
    """parses the arguments and returns a dictionary of them
    """
    parser = argparse.ArgumentParser(prog='remdups',description = __doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
    subparsers = parser.add_subparsers(help='*update* is default commnad. "remdups <command> --help" for help on the command. ',dest='cmd')
    cupdate = subparsers.add_parser('update',help=Command.update.__doc__)
-   cupdate.add_argument(#filter
-         '-f', '--filter', action='append', default=[],
-         help='Filter paths of such pattern. https://docs.python.org/3.6/library/fnmatch.html')
-   cupdate.add_argument(#exclude
-         '-e', '--exclude', action='append', default=[],
-         help='Exclude paths of such pattern. ! in front will not exclude it. https://docs.python.org/3.6/library/fnmatch.html')
-   cupdate.add_argument('fromdir',nargs='?',default='.',help="directory to take files form")
+   cupdate.add_argument(#full
+         '--full', action='store_true',
+         help='List also the folders whose modification time is as recorded in .remdups_dirs.')
+   cupdate.add_argument(#checkpoint_files
+         '--checkpoint-files', action='store', type=int,
+         help='Write (and fsync) the new hashes every so many files, instead of per folder.')
+   cupdate.add_argument(#checkpoint_seconds
+         '--checkpoint-seconds', action='store', type=float,
+         help='Write (and fsync) the new hashes every so many seconds, instead of per folder.')
+   cupdate.add_argument(#resume
+         '--resume', action='store_true',
+         help='Continue an interrupted update with checkpoints, with its fromdir, filter and exclude, after the last checkpoint.')
+   cupdate.add_argument(#device_jobs
+         '--device-jobs', action='store', type=int,
+         help='Hash in batches, with this many threads per device, reading in physical (FIEMAP) or inode order.')
+   cupdate.add_argument(#walk_jobs
+         '--walk-jobs', action='store', type=int,
+         help='List the next folders of the walk ahead with this many threads, e.g. on network file systems.')
+   cupdate.add_argument(#direct
+         '--direct', action='store_true',
+         help='Read with O_DIRECT, bypassing the page cache, if the file system allows it.')
+   _throttle_args(cupdate,'')
+   cupdate.add_argument(#archives
+         '--archives', action='store_true',
+         help='Hash also the files in zip and tar archives, as archive::member, without extracting them.')
+   cupdate.add_argument(#files_from
+         '--files-from', action='store', metavar='FILE',
+         type=argparse.FileType('r',encoding='utf-8',errors='surrogateescape'),
+         help='(Re)hash only the files listed in FILE (- for stdin), separated by newlines or NULs, instead of walking fromdir.')
+   cupdate.add_argument(#compact_ratio
+         '--compact-ratio', action='store', type=float, default=Command.compact_ratio,
+         help='Compact the .remdups_* files afterwards, if more than this part of the lines are replaced or removed ones.')
    cupdate.set_defaults(func=update)
    crm = subparsers.add_parser('rm',help=Command.rm.__doc__)
+   crm.add_argument(#top
+         '--top', action='store', type=int, metavar='K',
+         help='Only the K groups freeing most bytes (see report).')
+   crm.add_argument(#similar
+         '--similar', action='store', type=int, metavar='K',
+         help='Also remove images within hamming distance K of a larger one, by the perceptual hashes in .remdups_p.dhash.')
    crm.set_defaults(func=rm)
    cmv = subparsers.add_parser('mv',help=Command.mv.__doc__)
    cmv.set_defaults(func=mv)
    ccp = subparsers.add_parser('cp',help=Command.cp.__doc__)
    ccp.set_defaults(func=cp)
+   cdupsof = subparsers.add_parser('dupsof',help=Command.dupsof.__doc__)
+   cdupsof.add_argument('substr',nargs='?',help="tail substring of path")
+   cdupsof.set_defaults(func=dupsof)
+   cdupsof.add_argument(#server
+         '--server', action='store', nargs='?', const='.remdups_socket', metavar='ADDRESS',
+         help='Ask a running "remdups serve" at ADDRESS (unix socket path or [host]:port, default .remdups_socket).')
+   cdupsoftail = subparsers.add_parser('dupsoftail',help=Command.dupsoftail.__doc__)
+   cdupsoftail.add_argument('substr',nargs='?',help="substring of path")
+   cdupsoftail.set_defaults(func=dupsoftail)
+   cdupsoftail.add_argument(#server
+         '--server', action='store', nargs='?', const='.remdups_socket', metavar='ADDRESS',
+         help='Ask a running "remdups serve" at ADDRESS (unix socket path or [host]:port, default .remdups_socket).')
+   cimport = subparsers.add_parser('import',help=Command.import_sums.__doc__)
+   cimport.add_argument('manifest',help="SHA256SUMS, MD5SUMS,... file. Paths are relative to its directory. Not found paths are printed.")
+   cimport.set_defaults(func=import_sums)
+   cexport = subparsers.add_parser('export',help=Command.export_sums.__doc__)
+   cexport.add_argument('-s','--script', action="store", type=argparse.FileType('w',encoding='utf-8'), default='-',
+         help='Write to specified file instead of stdout.')
+   cexport.add_argument('--bsd', action='store_true',
+         help='BSD style "SHA256 (path) = hash" instead of "hash  path".')
+   cexport.add_argument('hashfile',nargs='?',help="the .remdups_c.y file, by default the first one")
+   cexport.set_defaults(func=export_sums)
+   clink = subparsers.add_parser('link',help=Command.link.__doc__)
+   clink.add_argument(#reflink
+         '--reflink', action='store_true',
+         help='Make copy-on-write clones (btrfs, xfs) instead of hardlinks.')
+   clink.set_defaults(func=link)
+   cverify = subparsers.add_parser('verify',help=Command.verify.__doc__)
+   cverify.add_argument('-s','--script', action="store", type=argparse.FileType('w',encoding='utf-8'), default='-',
+         help='Write the changed and missing files to specified file instead of stdout.')
+   cverify.add_argument(#part
+         '--part', action='store', type=int, metavar='N',
+         help='Verify only the next 1/N of the files, after those of the last run (.remdups_verify).')
+   cverify.add_argument(#jobs
+         '-j', '--jobs', action='store', type=int, default=4,
+         help='Number of threads hashing.')
+   cverify.add_argument(#direct
+         '--direct', action='store_true',
+         help='Read with O_DIRECT, bypassing the page cache, if the file system allows it.')
+   _throttle_args(cverify,'')
+   cverify.set_defaults(func=verify)
+   creport = subparsers.add_parser('report',help=Command.report.__doc__)
+   creport.add_argument('-s','--script', action="store", type=argparse.FileType('w',encoding='utf-8'), default='-',
+         help='Write to specified file instead of stdout.')
+   creport.add_argument(#top
+         '--top', action='store', type=int, metavar='K',
+         help='Only the K groups freeing most bytes.')
+   creport.add_argument(#mem_limit
+         '--mem-limit', action='store',
+         help='Do not load the .remdups_* files, but sort them on disk, using about this much memory, like 512M.')
+   creport.add_argument(#keep_in
+         '-i', '--keep-in', action='append', default=[],
+         help='Add substring to make other files of the duplicates be removed.')
+   creport.add_argument(#keep_out
+         '-o', '--keep-out', action='append', default=[],
+         help='Add substring to make this files of the duplicates be removed.')
+   creport.set_defaults(func=report)
+   cdupdirs = subparsers.add_parser('dupdirs',help=Command.dupdirs.__doc__)
+   cdupdirs.set_defaults(func=dupdirs)
+   cserve = subparsers.add_parser('serve',help=Command.serve.__doc__)
+   cserve.add_argument(#address
+         '--address', action='store', default='.remdups_socket',
+         help='Unix socket path or [host]:port (host defaults to 127.0.0.1) to listen at.')
+   cserve.set_defaults(func=serve)
+   ccompact = subparsers.add_parser('compact',help=Command.compact.__doc__)
+   ccompact.set_defaults(func=compact)
+   cwatch = subparsers.add_parser('watch',help=Command.watch.__doc__)
+   cwatch.add_argument(#debounce
+         '--debounce', action='store', type=float, default=1.0,
+         help='Seconds a file must stay unchanged before it is rehashed.')
+   cwatch.add_argument(#interval
+         '--interval', action='store', type=float, default=2.0,
+         help='Seconds between polls, if inotify is not available.')
+   cwatch.add_argument(#poll
+         '--poll', action='store_true',
+         help='Poll even if inotify is available.')
+   cwatch.set_defaults(func=watch)
+   for p in [cupdate,cwatch]:
+      p.add_argument(#filter
+            '-f', '--filter', action='append', default=[],
+            help='Filter paths of such pattern. https://docs.python.org/3.6/library/fnmatch.html')
+      p.add_argument(#exclude
+            '-e', '--exclude', action='append', default=[],
+            help='Exclude paths of such pattern. ! in front will not exclude it. https://docs.python.org/3.6/library/fnmatch.html')
+      p.add_argument('fromdir',nargs='?',default='.',help="directory to take files form")
    for p in [crm,cmv,ccp]:
-      p.add_argument('-s','--script', action="store", type=argparse.FileType('w',encoding='utf-8'), required=True,
-            help='Write to specified script. Required, because name of script determines the command format.')
+      p.add_argument('-s','--script', action="store", type=argparse.FileType('w',encoding='utf-8'),
+            help='Write to specified script. Required without --execute, because name of script determines the command format.')
+      p.add_argument(#execute
+            '-X', '--execute', action='store_true',
+            help='Do the commands in-process instead of writing a script.')
+      p.add_argument(#batch
+            '--batch', action='store_true',
+            help='Multi-argument commands per section and target folder, instead of one per file (.sh, and .bat for rm).')
+      p.add_argument(#dirs
+            '-d', '--dirs', action='store_true',
+            help='One command for each folder with the same files as another one, instead of for each of its files.')
+   for p in [crm,cmv,ccp,clink]:
+      p.add_argument(#dry_run
+            '--dry-run', action='store_true',
+            help='Like --execute, but only write the journal.')
+      p.add_argument(#jobs
+            '-j', '--jobs', action='store', type=int, default=4,
+            help='Number of threads doing the file operations.')
+      p.add_argument(#journal
+            '--journal', action='store', type=argparse.FileType('w',encoding='utf-8'),
+            help='Write the done commands to this python script, to inspect or replay them.')
+      p.add_argument(#mem_limit
+            '--mem-limit', action='store',
+            help='Do not load the .remdups_* files, but sort them on disk, using about this much memory, like 512M.')
       p.add_argument(#only_same_name
             '-n', '--only-same-name', action='store_true',
             help='Only check files with same name (same tail) for duplicates.')
@@ -719,6 +2717,10 @@ def parse_args(argv):
             '-a', '--safe', action='store_true',
             help='Do not trust filename+hash, '
             'but do an additional bytewise compare.')
+      p.add_argument(#direct
+            '--direct', action='store_true',
+            help='Read with O_DIRECT for --safe, bypassing the page cache.')
+      _throttle_args(p,'for --safe')
       p.add_argument(#html_files_suffix
             '-x', '--html-files-suffix', action='store', default='_files',
             help='When saving an html '
@@ -735,16 +2737,14 @@ def parse_args(argv):
             help='Add substring to make the remove command '
             'for the file containing it, be commented out.')
    for p in [cmv,ccp]:
+      p.add_argument(#from_index
+            '--from-index', action='store', metavar='FILE',
+            help='Take the files from this .remdups_x.y, made by update in its folder (e.g. on a backup host), instead of <fromdir>. '
+            'Those already in the .remdups_x.y of the same name here are left, found by sorting both on disk and merging.')
       p.add_argument('--sort',action='store',default='',
             help="Resort to new folders, like e.g. %y%m/%d%H%M%S. A _1, ... is added if different files result in the same name. \
                   This is only good for media files, where the original name was generated by the camera and holds no info. \
                   See https://docs.python.org/3/library/datetime.html#strftime-strptime-behavior".replace('%','%%'))
-   cdupsof = subparsers.add_parser('dupsof',help=Command.dupsof.__doc__)
-   cdupsof.add_argument('substr',nargs='?',help="tail substring of path")
-   cdupsof.set_defaults(func=dupsof)
-   cdupsoftail = subparsers.add_parser('dupsoftail',help=Command.dupsoftail.__doc__)
-   cdupsoftail.add_argument('substr',nargs='?',help="substring of path")
-   cdupsoftail.set_defaults(func=dupsoftail)
    def set_default_subparser(name):
       subparser_found = False
       for arg in argv[1:]:
@@ -760,7 +2760,16 @@ def parse_args(argv):
          if not subparser_found:
             argv.insert(1, name)
    set_default_subparser('update')
-   return parser.parse_args(argv[1:])
+   args = parser.parse_args(argv[1:])
+   if args.cmd in ['rm','cp','mv'] and not (args.script or args.execute or args.dry_run):
+      parser.error('the following arguments are required: -s/--script (or --execute)')
+   if getattr(args,'batch',False) and (args.execute or args.dry_run):
+      parser.error('--batch is for scripts, not with --execute or --dry-run')
+   if getattr(args,'dry_run',False) and not args.journal:
+      args.journal = sys.stdout
+   if getattr(args,'adaptive',False) and not (args.max_bytes_per_sec or args.max_files_per_sec):
+      parser.error('--adaptive needs --max-bytes-per-sec or --max-files-per-sec')
+   return args
 
 def main(args):
    args.func(args)
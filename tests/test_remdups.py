@@ -11,6 +11,10 @@ import os
 import tempfile
 import subprocess
 import shutil
+import time
+import json
+import threading
+import socket
 from itertools import product
 import PIL
 from PIL import ImageDraw
@@ -404,6 +408,715 @@ def test_rm(updatedhere,script):
     some_files = os.listdir('some_files')
     assert 'img.jpg' in some_files
 
+@pytest.mark.parametrize('poll',[True,False])
+def test_watch(updatedhere,poll):
+  hshr = Hasher()
+  hshr.load_hashes()
+  w = hshr.watch('.',exclude=['*.tmp'],debounce=0,interval=0.1,poll=poll)
+  assert next(w) == ([],[])
+  shutil.copy2('img.jpg','img2.jpg')
+  os.remove('sub/newimg.jpg')
+  with open('x.tmp','w') as f: f.write('x')
+  changed, deleted = [], []
+  for i in range(20):
+    c,d = next(w)
+    changed += c
+    deleted += d
+    if changed and deleted:
+      break
+  assert changed == [joinp('.','img2.jpg')]
+  assert deleted == [joinp('.','sub','newimg.jpg')]
+  w.close()
+  hshr = Hasher()
+  hshr.load_hashes()
+  assert len(hshr.duplicates('img2.jpg')) == 3
+  assert len(hshr.duplicates('/newimg.jpg')) == 0
+  assert '-\t'+joinp('.','sub','newimg.jpg')+'\n' in open('.remdups_c.sha256').readlines()
+  main(parse_args(['remdups','rm','-s','s.sh']))
+  assert 'sub/newimg.jpg' not in open('s.sh').read()
+
+def test_dirs_unchanged(emptyhashfiles):
+  past = time.time()-100
+  for d in ['.','sub','some_files']:
+    os.utime(d,(past,past))
+  main(parse_args(['remdups','update']))
+  with open('.remdups_dirs') as f:
+    assert len(f.readlines()) == 3
+  shutil.copy2('img.jpg','sub/img2.jpg')
+  os.utime('sub',(past,past)) #as if not changed
+  shutil.copy2('img.jpg','some_files/img2.jpg')
+  main(parse_args(['remdups','update']))
+  hshr = Hasher()
+  hshr.load_hashes()
+  assert joinp('.','some_files','img2.jpg') in hshr.path_hash
+  assert joinp('.','sub','img2.jpg') not in hshr.path_hash
+  main(parse_args(['remdups','update','--full']))
+  hshr = Hasher()
+  hshr.load_hashes()
+  assert joinp('.','sub','img2.jpg') in hshr.path_hash
+  assert len(hshr.duplicates('some_files/img2.jpg')) == 4
+
+def test_dirs_hashfiles(emptyhashfiles):
+  past = time.time()-100
+  for d in ['.','sub','some_files']:
+    os.utime(d,(past,past))
+  main(parse_args(['remdups','update']))
+  with open('.remdups_c.sha512','w'): pass
+  for hf in emptyhashfiles:
+    os.remove(hf)
+  os.utime('.',(past,past))
+  main(parse_args(['remdups','update'])) #stamps of other hash files are not trusted
+  hshr = Hasher()
+  hshr.load_hashes()
+  assert len(hshr.path_hash) == 7
+  assert sorted(hshr.duplicates('sub/img.jpg')) == ['./img.jpg','./some_files/img.jpg']
+
+def test_compact(updatedhere):
+  hf = '.remdups_c.sha256'
+  with open(hf) as f:
+    lns = f.readlines()
+  with open(hf,'a') as f:
+    f.writelines(lns[:2]) #repeated
+    f.write('-\t'+joinp('.','some.html')+'\n')
+  os.remove(joinp('sub','newimg.jpg'))
+  main(parse_args(['remdups','update','--compact-ratio','1']))
+  with open(hf) as f:
+    assert len(f.readlines()) == 10
+  dropped = main(parse_args(['remdups','compact']))
+  with open(hf) as f:
+    clns = f.readlines()
+  assert len(clns) == 5
+  assert all([x in lns for x in clns])
+  assert not [x for x in os.listdir() if x.startswith(hf+'.')] #no temporary left
+  with open(hf,'a') as f:
+    f.writelines(clns*2)
+  main(parse_args(['remdups','update','--compact-ratio','0.3']))
+  with open(hf) as f:
+    assert len(f.readlines()) == 5
+  with open(hf,'a') as f:
+    f.writelines(clns*4)
+  Command().update() #same default as the command line
+  with open(hf) as f:
+    assert len(f.readlines()) == 5
+
+def test_checkpoint_resume(emptyhashfiles,monkeypatch):
+  hshr = Hasher()
+  hshr.load_hashes()
+  g = hshr.scandir('.',checkpoint_files=2)
+  first = [next(g) for i in range(3)]
+  g.close() #interrupted
+  with open('.remdups_resume') as f:
+    assert json.load(f)['last'] == os.path.relpath(first[-1]).split(os.sep)
+  for hf in emptyhashfiles:
+    with open(hf) as f:
+      assert len(f.readlines()) == 3
+    with open(hf,'a') as f:
+      f.write('0123\t./torn') #crash while writing
+  hashed = []
+  orighash = Hasher.hash
+  def hash(self,repth,content=None):
+    hashed.append(repth)
+    return orighash(self,repth,content)
+  monkeypatch.setattr(Hasher,'hash',hash)
+  main(parse_args(['remdups','update','--resume','--checkpoint-files','2']))
+  assert not os.path.exists('.remdups_resume')
+  assert len(hashed) == 4
+  assert not set(hashed)&set(first)
+  for hf in emptyhashfiles:
+    with open(hf) as f:
+      lns = f.readlines()
+    assert len(lns) == 7
+    assert not [x for x in lns if 'torn' in x]
+  for hf in emptyhashfiles:
+    with open(hf,'a') as f:
+      f.write('0123\t./torn\n') #invalid hash
+      f.write('-\t'+joinp('.','sub','img.jpg')+'\n')
+  hshr = Hasher()
+  hshr.load_hashes()
+  assert len(hshr.path_hash) == 6
+
+@pytest.mark.parametrize('cmd',['rm','cp'])
+def test_mem_limit(updated,cmd):
+  here,other = updated
+  with open('.remdups_c.sha256') as f:
+    paths = [x.split('\t')[1] for x in f.readlines()]
+  with open('.remdups_c.sha256','a') as f: #replaced and removed
+    f.write('{}\t{}'.format('0'*64,paths[0]))
+    f.write('-\t{}'.format(paths[1]))
+  main(parse_args(['remdups',cmd,'-s','inmem.sh','-a']))
+  main(parse_args(['remdups',cmd,'-s','ext.sh','-a','--mem-limit','300']))
+  with open('inmem.sh') as f:
+    inmem = f.read().split('\n')
+  with open('ext.sh') as f:
+    ext = f.read().split('\n')
+  assert len(inmem) > 5
+  assert sorted(inmem) == sorted(ext)
+  assert Command(load=False).rm(script=open('ext.sh','w'),mem_limit='300') is None #written as they come
+  with open('ext.sh') as f:
+    assert f.read().split('\n')[0] == '### vim: set fdm=marker'
+  hshr = Hasher()
+  hshr.load_hashes()
+  assert sorted(hshr.hash_paths.items()) == list(hshr.external_groups(300))
+
+def test_import_export(dirwithfiles,capfd):
+  for hf in glob('.remdups_*'):
+    os.remove(hf)
+  os.mkdir('sums')
+  shutil.copy2('img.jpg','sums')
+  shutil.copy2('newimg.jpg','sums/copy.jpg')
+  sha = lambda f: hashlib.sha256(open(f,'rb').read()).hexdigest()
+  with open('sums/SHA256SUMS','w') as f:
+    f.write('{}  img.jpg\n'.format(sha('sums/img.jpg')))
+    f.write('SHA256 (copy.jpg) = {}\n'.format(sha('sums/copy.jpg')))
+    f.write('{} *gone.jpg\n'.format(sha('sums/img.jpg')))
+  main(parse_args(['remdups','import','sums/SHA256SUMS']))
+  out, err = capfd.readouterr()
+  assert 'gone.jpg' in out
+  assert glob('.remdups_*') == ['.remdups_c.sha256']
+  with open('.remdups_c.sha256') as f:
+    lns = f.readlines()
+  assert len(lns) == 2
+  assert all(['sums//' in x for x in lns])
+  main(parse_args(['remdups','import','sums/SHA256SUMS']))
+  with open('.remdups_c.sha256') as f:
+    assert len(f.readlines()) == 2 #already there
+  main(parse_args(['remdups','export','-s','SUMS']))
+  with open('SUMS') as f:
+    assert f.read() == '{}  sums/img.jpg\n{}  sums/copy.jpg\n'.format(sha('img.jpg'),sha('newimg.jpg'))
+  main(parse_args(['remdups','export','-s','BSDSUMS','--bsd']))
+  with open('BSDSUMS') as f:
+    assert f.readline() == 'SHA256 (sums/img.jpg) = {}\n'.format(sha('img.jpg'))
+  with open('MD5SUMS','w') as f:
+    f.write('{}  img.jpg\n'.format(hashlib.md5(open('img.jpg','rb').read()).hexdigest()))
+  with pytest.raises(ValueError):
+    main(parse_args(['remdups','import','MD5SUMS']))
+
+def test_export_current(updatedhere):
+  sha = lambda f: hashlib.sha256(open(f,'rb').read()).hexdigest()
+  with open('sub/newimg.jpg','ab') as f:
+    f.write(b'changed')
+  os.remove('sometxt.txt')
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert list(hasher.scanlisted(['./sub/newimg.jpg','./sometxt.txt'])) == ['./sub/newimg.jpg']
+  main(parse_args(['remdups','export','-s','SUMS']))
+  with open('SUMS') as f:
+    sums = [l.split('  ',1) for l in f.read().split('\n') if l]
+  paths = [p for h,p in sums]
+  assert sorted(paths) == sorted(set(paths)) and len(paths) == 6
+  assert 'sometxt.txt' not in paths
+  assert all([h == sha(p) for h,p in sums])
+
+def test_export_torn(updatedhere):
+  with open('.remdups_c.sha256','a') as f:
+    f.write('0123abc')
+  main(parse_args(['remdups','export','-s','SUMS']))
+  with open('.remdups_c.sha256','a') as f:
+    f.write('\t./torn.jpg')
+  main(parse_args(['remdups','export','-s','SUMS2']))
+  for fn in ['SUMS','SUMS2']:
+    with open(fn) as f:
+      sums = [l for l in f.read().split('\n') if l]
+    assert len(sums) == 7 and not [l for l in sums if 'torn' in l or '0123abc' in l]
+
+def test_rm_execute(updatedhere,capfd):
+  capfd.readouterr()
+  main(parse_args(['remdups','rm','--dry-run','-o','.txt']))
+  out, err = capfd.readouterr()
+  assert "remove('./sometxt.txt')" in out #journal to stdout
+  main(parse_args(['remdups','rm','--dry-run','--journal','j.py','-o','.txt']))
+  assert 'sub' in os.listdir('.')
+  with open('j.py') as f:
+    dryrun = f.read()
+  assert "remove('./some.html')" not in dryrun
+  assert "remove('./sometxt.txt')" in dryrun
+  assert "remove('./sub/img.jpg')" in dryrun
+  main(parse_args(['remdups','rm','-X','--journal','j.py','-o','.txt','-j','2']))
+  with open('j.py') as f:
+    assert f.read() == dryrun
+  ld = os.listdir('.')
+  assert 'img.jpg' in ld
+  assert 'newimg.jpg' in ld
+  assert 'sometxt.txt' not in ld
+  assert 'sub' not in ld
+  assert 'img.jpg' in os.listdir('some_files')
+
+def test_mv_execute(updated):
+  here,other = updated
+  acommand = Command()
+  journal = acommand.mv(execute=True,jobs=1,keep_in=['sub'],comment_out=['some'])
+  assert acommand.errors == []
+  assert any(['move(' in x for x in journal])
+  ld = os.listdir('.')
+  assert 'some.html' not in ld
+  assert 'img.jpg' in os.listdir('sub')
+  assert 'newimg.jpg' in os.listdir('sub')
+  assert 'img.jpg' not in os.listdir(joinp(other,'sub'))
+  acommand = Command()
+  acommand.mv(execute=True,keep_in=['sub'],comment_out=['some'])
+  assert len(acommand.errors) > 0 #moved already
+
+def test_link(updatedhere,monkeypatch):
+  main(parse_args(['remdups','link','--dry-run','-o','.txt']))
+  assert os.stat('sub/img.jpg').st_ino != os.stat('img.jpg').st_ino
+  acommand = Command()
+  journal = acommand.link(keep_out=['.txt'],comment_out=['some_files'])
+  assert acommand.errors == []
+  assert "relink('./img.jpg', './sub/img.jpg')" in journal
+  assert "relink('./some.html', './sometxt.txt')" in journal
+  assert os.stat('sub/img.jpg').st_ino == os.stat('img.jpg').st_ino
+  assert os.stat('sub/newimg.jpg').st_ino == os.stat('newimg.jpg').st_ino
+  assert os.stat('some_files/img.jpg').st_ino != os.stat('img.jpg').st_ino
+  assert os.stat('some.html').st_ino == os.stat('sometxt.txt').st_ino
+  assert [x for x in os.listdir('sub') if 'remdups' in x] == []
+  try:
+    relink('img.jpg','some_files/img.jpg',reflink=True)
+  except OSError: #file system without reflinks
+    assert [x for x in os.listdir('some_files') if 'remdups' in x] == []
+  assert filecmp.cmp('img.jpg','some_files/img.jpg',False)
+  shutil.copy2('img.jpg','sub/copy.jpg')
+  others = ['.copy.jpg.00000000.remdups~','.copy.jpg.remdups~']
+  for other in others:
+    with open(joinp('sub',other),'w') as f: f.write('not ours')
+  names = iter([b'\0'*4,b'\1'*4])
+  monkeypatch.setattr(os,'urandom',lambda n: next(names))
+  relink('img.jpg','sub/copy.jpg') #retried with another name
+  assert os.stat('sub/copy.jpg').st_ino == os.stat('img.jpg').st_ino
+  assert sorted([x for x in os.listdir('sub') if 'remdups' in x]) == others
+  for other in others:
+    with open(joinp('sub',other)) as f:
+      assert f.read() == 'not ours'
+
+def test_script_or_execute(tmpworkdir):
+  with pytest.raises(SystemExit):
+    parse_args(['remdups','rm'])
+
+def test_dirs(dirwithfiles):
+  shutil.copytree('sub','sub2')
+  os.mkdir('deep')
+  shutil.copytree('sub','deep/sub')
+  shutil.copytree('sub','inc')
+  main(parse_args(['remdups','update']))
+  with open('inc/new.txt','w') as f: f.write('not indexed')
+  acommand = Command()
+  assert acommand.dupdirs() == [['./deep/sub','./sub','./sub2']]
+  acommand = Command()
+  acommand.rm(script=open('rm.sh','w'),dirs=True)
+  with open('rm.sh') as f:
+    script = f.read().split('\n')
+  assert "rm -rf ./sub2" in script
+  assert "rm -rf ./deep/sub" in script
+  assert "#>#rm -rf ./sub" in script
+  assert "rm -f ./img.jpg" in script
+  assert "rm -f ./inc/img.jpg" in script
+  assert [x for x in script if x.startswith("rm -f ./sub") or x.startswith("rm -f ./deep")] == []
+  acommand = Command()
+  acommand.rm(execute=True,dirs=True)
+  assert acommand.errors == []
+  assert not os.path.exists('deep') #emptied folders are removed, too
+  assert not os.path.exists('sub2')
+  assert sorted(os.listdir('sub')) == ['img.jpg','newimg.jpg']
+  for d in ['a','b']:
+    os.mkdir(d)
+    with open(d+'/important.txt','w') as f: f.write('keep')
+  main(parse_args(['remdups','update']))
+  acommand = Command()
+  acommand.rm(script=open('rm.sh','w'),dirs=True,comment_out=['important'])
+  with open('rm.sh') as f:
+    script = f.read().split('\n')
+  assert [x for x in script if x.startswith('rm -rf')] == []
+  assert "#c#rm -f ./b/important.txt" in script
+
+def test_similar(tmpworkdir):
+  pattern = lambda f: PIL.Image.frombytes('L',(256,192),bytes([f(x,y)%256 for y in range(192) for x in range(256)]))
+  img = pattern(lambda x,y: x*y//64+x)
+  img.save('photo.jpg','jpeg',quality=95)
+  img.resize((128,96)).save('photo_small.jpg','jpeg',quality=50)
+  pattern(lambda x,y: (x//16+y//16)%2*255).save('other.jpg','jpeg')
+  with open('.remdups_p.dhash','w'):pass
+  main(parse_args(['remdups','update']))
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert sorted(hasher.path_phash) == ['./other.jpg','./photo.jpg','./photo_small.jpg']
+  ph = {p:int(h,16) for p,h in hasher.path_phash.items()}
+  assert hamming(ph['./photo.jpg'],ph['./photo_small.jpg']) <= 4
+  assert hamming(ph['./photo.jpg'],ph['./other.jpg']) > 10
+  tree = BKTree(ph.values())
+  assert sorted([d for d,v in tree.query(ph['./photo.jpg'],64)]) == sorted([hamming(ph['./photo.jpg'],v) for v in set(ph.values())])
+  main(parse_args(['remdups','rm','-s','rm.sh']))
+  assert not os.path.exists('rm.sh') or 'photo' not in open('rm.sh').read()
+  main(parse_args(['remdups','rm','--similar','4','-s','rm.sh']))
+  with open('rm.sh') as f:
+    script = f.read().split('\n')
+  assert "rm -f ./photo_small.jpg" in script
+  assert "#>#rm -f ./photo.jpg" in script
+  assert [x for x in script if 'other' in x] == []
+  hasher.forget('./other.jpg')
+  hasher.update_hashfiles()
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert sorted(hasher.path_phash) == ['./photo.jpg','./photo_small.jpg']
+
+def test_sampled(tmpworkdir):
+  data = bytearray(os.urandom(1<<20))
+  for fn in ['big1','big2','big3']:
+    with open(fn,'wb') as f: f.write(data)
+  with open('big3','r+b') as f:
+    f.seek(100000) #between the sampled chunks
+    f.write(bytes([data[100000]^1]))
+  with open('big4','wb') as f: f.write(data+b'x')
+  with open('.remdups_s.sha256','w'):pass
+  main(parse_args(['remdups','update']))
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert sorted(hasher.duplicates('big1')) == ['./big2','./big3']
+  assert hasher.duplicates('big4') == []
+  main(parse_args(['remdups','rm','--safe','-s','rm.sh']))
+  with open('rm.sh') as f:
+    script = f.read()
+  assert 'rm -f ./big2' in script
+  assert 'big3' not in script
+
+@pytest.mark.parametrize('address',['sock','127.0.0.1:0'])
+def test_serve(updated,address,capfd):
+  acommand = Command()
+  server = acommand.server(address=address)
+  if ':' in address:
+    address = '127.0.0.1:{}'.format(server.server_address[1])
+  thread = threading.Thread(target=server.serve_forever)
+  thread.start()
+  try:
+    direct = Command()
+    assert query_server(address,cmd='dupsof',substr='sub/img.jpg') == direct.dupsof(substr='sub/img.jpg')
+    assert query_server(address,cmd='dupsoftail',substr='img.jpg') == direct.dupsoftail(substr='img.jpg')
+    with pytest.raises(ValueError):
+      query_server(address,cmd='dupsof',substr='img.jpg') #not unique
+    with pytest.raises(ValueError):
+      query_server(address,cmd='other')
+    key = [p for p in direct.hasher.path_hash if p.endswith(os.sep*2+'img.jpg')][0]
+    assert query_server(address,cmd='dupsof',substr=key) == [p for p in direct.hasher.hash_paths[direct.hasher.path_hash[key]] if p != key]
+    assert query_server(address,cmd='reload') == len(direct.hasher.path_hash)
+    capfd.readouterr()
+    main(parse_args(['remdups','dupsof','--server',address,'sub/img.jpg']))
+    out, err = capfd.readouterr()
+    assert out.split() == direct.dupsof(substr='sub/img.jpg')
+  finally:
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def test_serve_nounix(updated,monkeypatch):
+  import remdups.remdups as module
+  monkeypatch.setattr(module,'_UnixServer',None)
+  monkeypatch.delattr(socket,'AF_UNIX')
+  with pytest.raises(ValueError):
+    Command().server(address='.remdups_socket')
+  with pytest.raises(ValueError):
+    query_server('.remdups_socket',cmd='reload')
+
+@pytest.mark.parametrize('sep',['\n','\0'])
+def test_files_from(updatedhere,sep):
+  with open('sometxt.txt','w') as f: f.write('changed')
+  os.remove('newimg.jpg')
+  with open('new.txt','w') as f: f.write('new')
+  with open('ignored.txt','w') as f: f.write('not listed')
+  with open('../list','w') as f:
+    f.write(sep.join(['sometxt.txt','newimg.jpg','new.txt','./sub/img.jpg',os.path.abspath('../list')])+sep)
+  main(parse_args(['remdups','update','--files-from','../list']))
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert './new.txt' in hasher.path_hash
+  assert './ignored.txt' not in hasher.path_hash
+  assert './newimg.jpg' not in hasher.path_hash
+  assert hasher.duplicates('sometxt.txt') == []
+  assert hasher.duplicates('some.html') == []
+  assert sorted(hasher.duplicates('sub/img.jpg')) == ['./img.jpg','./some_files/img.jpg']
+  os.remove('../list')
+
+def test_device_jobs(emptyhashfiles,monkeypatch):
+  monkeypatch.setattr(Hasher,'batchsize',2)
+  past = time.time()-10
+  for d in ['.','sub','some_files']:
+    os.utime(d,(past,past))
+  main(parse_args(['remdups','update','--device-jobs','2']))
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert len(hasher.path_hash) == 7
+  assert sorted(hasher.duplicates('sub/img.jpg')) == ['./img.jpg','./some_files/img.jpg']
+  assert sorted(hasher.dir_stamp) == ['.','./some_files','./sub']
+  sequential = Hasher()
+  sequential.clear()
+  for p in hasher.path_hash:
+    sequential.hash(p)
+  assert sequential.path_hash == hasher.path_hash
+
+@pytest.mark.parametrize('direct',[False,True])
+def test_direct(emptyhashfiles,direct):
+  data = os.urandom(100000)
+  for fn in ['a.bin','b.bin']:
+    with open(fn,'wb') as f: f.write(data)
+  with open('c.bin','wb') as f: f.write(data[:-1]+bytes([data[-1]^1]))
+  assert samecontent('a.bin','b.bin',direct)
+  assert not samecontent('a.bin','c.bin',direct)
+  assert not samecontent('a.bin','img.jpg',direct)
+  args = ['remdups','update']+(direct and ['--direct'] or [])
+  main(parse_args(args))
+  hasher = Hasher()
+  hasher.load_hashes()
+  plain = Hasher()
+  plain.clear()
+  for p in hasher.path_hash:
+    plain.hash(p)
+  assert plain.path_hash == hasher.path_hash
+  sha = lambda b: hashlib.sha256(b).hexdigest()
+  #read in Hasher.readsize blocks, but (b)lock as with 8K reads: along with (c)ontent all of it
+  assert hasher.path_hash['./a.bin'] == sha(data)+sha(data)+sha(data)
+  blockonly = Hasher()
+  blockonly.hashfiles = ['.remdups_b.sha256']
+  blockonly.clear()
+  blockonly.hash('./a.bin')
+  assert blockonly.path_hash['./a.bin'] == sha(data[:8192])
+  main(parse_args(['remdups','rm','--safe','-s','rm.sh']+(direct and ['--direct'] or [])))
+  with open('rm.sh') as f:
+    script = f.read()
+  assert 'a.bin' in script and 'b.bin' in script and 'c.bin' not in script
+
+def test_throttle(emptyhashfiles):
+  with pytest.raises(SystemExit):
+    parse_args(['remdups','update','--adaptive'])
+  start = time.time()
+  main(parse_args(['remdups','update','--max-files-per-sec','5','--adaptive']))
+  assert time.time()-start >= 0.3 #5 files at once, then 0.2s per file
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert len(hasher.path_hash) == 7
+  size = sum([os.path.getsize(p) for p in hasher.path_hash])
+  for hf in emptyhashfiles:
+    with open(hf,'w'):pass
+  start = time.time()
+  main(parse_args(['remdups','update','--max-bytes-per-sec',str(size//2)]))
+  assert time.time()-start >= 0.5 #half at once, the other half in 1s
+
+def test_verified(updatedhere,monkeypatch):
+  import remdups.remdups as module
+  compared = []
+  orig = module.samecontent
+  def samecontent(f1,f2,*args):
+    compared.append((f1,f2))
+    return orig(f1,f2,*args)
+  monkeypatch.setattr(module,'samecontent',samecontent)
+  main(parse_args(['remdups','rm','--safe','-s','s1.sh']))
+  assert len(compared) == 4 #some.html, img.jpg (2), newimg.jpg
+  with open('.remdups_verified') as f:
+    assert len(f.readlines()) == 4
+  del compared[:]
+  main(parse_args(['remdups','rm','--safe','-s','s2.sh']))
+  assert compared == []
+  assert open('s1.sh').read() == open('s2.sh').read()
+  past = time.time()-100
+  os.utime('sub/newimg.jpg',(past,past))
+  main(parse_args(['remdups','rm','--safe','-s','s2.sh']))
+  assert compared == [('./newimg.jpg','./sub/newimg.jpg')]
+  assert Command().compact() == 1
+  with open('.remdups_verified') as f:
+    assert len(f.readlines()) == 4
+
+def test_archives(emptyhashfiles):
+  import zipfile, tarfile
+  with zipfile.ZipFile('a.zip','w',zipfile.ZIP_DEFLATED) as z:
+    z.write('img.jpg')
+    z.write('some.html','x/page.html')
+  with tarfile.open('b.tar.gz','w:gz') as t:
+    t.add('newimg.jpg','y/newimg.jpg')
+  main(parse_args(['remdups','update','--archives']))
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert './a.zip::img.jpg' in hasher.duplicates('sub/img.jpg')
+  assert hasher.duplicates('b.tar.gz::y/newimg.jpg') == ['./newimg.jpg','./sub/newimg.jpg']
+  assert sorted(hasher.duplicates('img.jpg')) == ['./a.zip::img.jpg','./some_files/img.jpg','./sub/img.jpg'] #./img.jpg
+  assert './a.zip::x/page.html' in hasher.duplicates('sometxt.txt')
+  main(parse_args(['remdups','rm','-s','rm.sh','-i','a.zip']))
+  with open('rm.sh') as f:
+    script = f.read().split('\n')
+  assert '#c#rm -f ./a.zip::img.jpg' in script
+  assert '#c#rm -f ./b.tar.gz::y/newimg.jpg' in script
+  assert '#>#rm -f ./img.jpg' in script
+  main(parse_args(['remdups','export','-s','SUMS']))
+  with open('SUMS') as f:
+    sums = f.read()
+  assert 'img.jpg' in sums and '::' not in sums
+  main(parse_args(['remdups','cp','-s','cp.sh','--sort','%y%m']))
+  with open('cp.sh') as f:
+    script = f.read().split('\n')
+  assert [l for l in script if l.startswith('#c#') and 'a.zip::x/page.html' in l]
+  assert Command().compact() == 0
+  assert len(Hasher().hashfiles) == 3
+  with zipfile.ZipFile('e.zip','w') as z:
+    z.writestr('plain.txt','hello')
+    z.writestr('secret.txt','world')
+  with open('e.zip','r+b') as f:
+    data = f.read()
+    f.seek(data.rfind(b'PK\x01\x02')+8)
+    f.write(bytes([data[data.rfind(b'PK\x01\x02')+8]|1]))#secret.txt encrypted
+  assert list(Hasher().hashmembers('./e.zip')) == ['./e.zip::plain.txt']
+  main(parse_args(['remdups','update','--archives']))
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert './e.zip::plain.txt' in hasher.path_hash and './e.zip::secret.txt' not in hasher.path_hash
+
+def test_stream_samples(tmpworkdir):
+  import remdups.remdups as module
+  data = os.urandom(700000)
+  with open('big','wb') as f: f.write(data)
+  blocks = [data[i:i+10000] for i in range(0,len(data),10000)]
+  assert list(module._stream_samples(iter(blocks),len(data),8,65536)) == list(module._samples('big',8,65536))
+
+def test_api(emptyhashfiles):
+  hasher = Hasher()
+  hashed = dict(hasher.iter_hashed('.'))
+  assert len(hashed) == 7
+  assert hashed['./img.jpg'] == hashed['./sub/img.jpg']
+  groups = list(Command().iter_groups(keep_out=['sub']))
+  assert len(groups) == 3
+  g = [g for g in groups if g.keep == './img.jpg'][0]
+  assert g.paths == ['./img.jpg','./some_files/img.jpg','./sub/img.jpg']
+  assert g.same_tail and g.size == os.path.getsize('img.jpg')
+  assert g.digest == hashed['./img.jpg']
+  with pytest.raises(AttributeError):
+    g.other = 1
+  assert [g.keep for g in Command().iter_groups(only_same_name=True)] != []
+  assert len(list(Command().iter_groups(only_same_name=True))) == 2
+  external = Command(load=False).iter_groups(mem_limit='1K')
+  assert sorted([g.paths for g in external]) == sorted([g.paths for g in groups])
+
+def test_batch_rm(updatedhere,monkeypatch):
+  main(parse_args(['remdups','rm','-s','s.sh','-o','.txt']))
+  removed = [l.split()[-1] for l in open('s.sh').read().split('\n') if l.startswith('rm -f ')]
+  assert len(removed) > 2
+  monkeypatch.setattr(Command,'batchlimit',[30,8000,0])
+  main(parse_args(['remdups','rm','-s','b.sh','-o','.txt','--batch']))
+  script = open('b.sh').read().split('\n')
+  assert [l for l in script if l.startswith('rm -f ./')] == []
+  assert sorted([l[3:].split()[-1] for l in script if l.startswith('#=#')]) == sorted(removed)
+  batches = [l for l in script if l.startswith('rm -f -- ')]
+  assert len(batches) > 1 #split at the limit
+  assert sorted(sum([l.split()[3:] for l in batches],[])) == sorted(removed)
+  assert run('b.sh').returncode == 0
+  assert [f for f in removed if os.path.exists(f)] == []
+  assert os.path.exists('img.jpg')
+
+def test_batched_many(tmpworkdir):
+  acommand = Command(load=False)
+  acommand.init_command(cmd='rm',script=open('b.sh','w'),batch=True)
+  paths = ['./d/f{}.txt'.format(i) for i in range(200000)]
+  for p in paths:
+    acommand.add_batch(False,p)
+  lines = list(acommand.batched())
+  assert all([len(l) <= Command.batchlimit[0] for l in lines])
+  assert sum([l.split()[3:] for l in lines],[]) == paths
+  assert len(lines[0]) > Command.batchlimit[0]-20
+
+@pytest.mark.parametrize('args',[['link','--batch'],['link','--dirs'],['rm','-X','--batch'],['cp','--dry-run','--batch']])
+def test_batch_dirs_args(tmpworkdir,args):
+  with pytest.raises(SystemExit):
+    parse_args(['remdups']+args)
+
+def test_batch_cp(updated):
+  here,other = updated
+  main(parse_args(['remdups','cp','-s','b.sh','-o','sub','--batch']))
+  script = open('b.sh').read().split('\n')
+  assert [l for l in script if l.startswith('mkdir -p . && cp -- ')]
+  assert run('b.sh').returncode == 0
+  assert sorted(os.listdir('.')) == sorted(['b.sh','img.jpg','newimg.jpg','some.html','sometxt.txt','some_files']+glob('.remdups_*'))
+
+def test_verify(updatedhere,capfd):
+  hasher = Hasher()
+  hasher.load_hashes()
+  seen = []
+  for i in range(3):
+    seen.extend([p for s,p in hasher.verify(part=3,jobs=2)])
+    assert json.load(open('.remdups_verify'))['last'] == seen[-1]
+  assert len(seen) == 9 and set(seen) == set(hasher.path_hash) #3 per run, wrapping around
+  paths = sorted(hasher.path_hash)
+  assert [p for s,p in hasher.verify(part=3)][0] == paths[paths.index(seen[-1])+1]
+  with open('.remdups_n.md5','w'): pass #added hash file, without the paths
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert set([s for s,p in hasher.verify()]) == {'ok'}
+  with open('sub/newimg.jpg','r+b') as f:
+    f.seek(100)
+    b = f.read(1)
+    f.seek(100)
+    f.write(bytes([b[0]^1])) #bit rot
+  os.remove('sometxt.txt')
+  capfd.readouterr()
+  main(parse_args(['remdups','verify','-j','3','--max-files-per-sec','100']))
+  out, err = capfd.readouterr()
+  assert out.split('\n') == ['missing\t./sometxt.txt','changed\t./sub/newimg.jpg']
+
+def test_report(updatedhere,capfd):
+  hasher = Hasher()
+  hasher.load_hashes()
+  assert hasher.path_size['./img.jpg'] == os.path.getsize('img.jpg')
+  capfd.readouterr()
+  main(parse_args(['remdups','report']))
+  out, err = capfd.readouterr()
+  report = [json.loads(l) for l in out.split('\n')]
+  assert len(report) == 3
+  assert [r['reclaimable'] for r in report] == sorted([r['reclaimable'] for r in report],reverse=True)
+  assert report[0]['paths'] == ['./img.jpg','./some_files/img.jpg','./sub/img.jpg']
+  assert report[0]['reclaimable'] == 2*os.path.getsize('img.jpg')
+  main(parse_args(['remdups','report','--top','1','--mem-limit','1K']))
+  out, err = capfd.readouterr()
+  assert [json.loads(l) for l in out.split('\n')] == report[:1]
+  main(parse_args(['remdups','rm','--top','1','-s','rm.sh']))
+  with open('rm.sh') as f:
+    script = f.read()
+  assert 'img.jpg' in script and 'newimg.jpg' not in script and 'some.html' not in script
+
+def test_walk_jobs(emptyhashfiles):
+  os.makedirs('deep/a/b')
+  os.makedirs('deep/c')
+  for p in ['deep/a/b/x.txt','deep/c/y.txt']:
+    with open(p,'w') as f: f.write(p)
+  hasher = Hasher()
+  sequential = [(r,d,f) for r,d,f,s in hasher.walk('.',False)]
+  parallel = [(r,d,f) for r,d,f,s in hasher.walk('.',False,4)]
+  assert parallel == sequential
+  pruned = []
+  for root, dirs, files, stamp in hasher.walk('.',False,4):
+    pruned.append(root)
+    dirs[:] = [d for d in dirs if d != 'a']
+  assert './deep/c' in pruned and './deep/a' not in pruned
+  main(parse_args(['remdups','update','--walk-jobs','3']))
+  hasher.load_hashes()
+  assert len(hasher.path_hash) == 9
+  assert hasher.duplicates('sub/img.jpg') != []
+
+def test_from_index(here_otherdir):
+  here,other = here_otherdir
+  shutil.copy2(os.path.join(other,'img.jpg'),'kept.jpg')
+  main(parse_args(['remdups','update']))
+  os.chdir(other)
+  main(parse_args(['remdups','update']))
+  os.chdir(here)
+  index = os.path.join(os.path.relpath(other),'.remdups_c.sha256')
+  hasher = Hasher()
+  joined = {h:(present,paths) for h,present,paths in hasher.join(index,1000)}
+  assert len(joined) == 3
+  present = [pp for pp in joined.values() if pp[0]]
+  assert present[0][0] == ['./kept.jpg'] and len(present[0][1]) == 3
+  assert all([os.sep*2 in p for pp in joined.values() for p in pp[1]])
+  main(parse_args(['remdups','cp','-s','s.sh','--from-index',index,'--mem-limit','1000']))
+  script = open('s.sh').read().split('\n')
+  assert '### Already Present {{{' in script
+  assert len([l for l in script if l.startswith('#>#') and 'img.jpg' in l and 'newimg' not in l]) == 3
+  assert run('s.sh').returncode == 0
+  ld = os.listdir('.')
+  assert 'img.jpg' not in ld and 'newimg.jpg' in ld and 'some.html' in ld
+  with pytest.raises(ValueError):
+    list(hasher.join(os.path.join(os.path.relpath(other),'.remdups_x.md5'),1000))
+
 ##other
 def test_convuinx(request):
   fn=r"U:\w&k(2)\wf g.txt"